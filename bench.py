@@ -0,0 +1,578 @@
+import argparse
+import contextlib
+import email.parser
+import hashlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Benchmarks the bot against in-process fake Telegram and Google Drive servers:
+#   python bench.py [--users 50 --reminders 20 ...] [--output results.json]
+# Every scenario reports throughput and p50/p99 latency; the results are printed as JSON so
+# runs can be compared. Nothing talks to the real APIs and the database is a temporary file.
+
+TOKEN = "123456:bench"
+
+
+class FakeBackend:
+    # One HTTP server playing both Telegram (Bot API and file downloads) and Google Drive
+    # (resumable uploads, media downloads and batched deletes). Requests are
+    # delayed by `latency` seconds and a share of them fails: 429 with retry_after for Telegram,
+    # 500 for Drive. A share of documents resent by file_id is refused, so they come from Drive.
+
+    def __init__(self, telegram_latency=0.0, telegram_errors=0.0, drive_latency=0.0, drive_errors=0.0,
+                 file_size=64 * 1024, stale_file_ids=0.0):
+        self.telegram_latency = telegram_latency
+        self.telegram_errors = telegram_errors
+        self.drive_latency = drive_latency
+        self.drive_errors = drive_errors
+        self.file_size = file_size
+        self.stale_file_ids = stale_file_ids
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.blobs = {}
+        self.uploads = {}
+        self.calls = {}
+        self.updates = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def next_id(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+    def message(self, chat_id, **extra):
+        return dict(message_id=self.next_id(), date=int(time.time()), chat={"id": chat_id, "type": "private"},
+                    **extra)
+
+    def content(self, path):
+        # The same Telegram file always has the same bytes, so duplicates can be recognised.
+        return (hashlib.sha256(path.encode()).digest() * (self.file_size // 32 + 1))[:self.file_size]
+
+    def resends(self, method, params):
+        # Whether the request sends a file Telegram already has by its file_id.
+        if method == "sendDocument":
+            return "document" in params
+        if method == "sendMediaGroup":
+            return any(not media["media"].startswith("attach://") for media in json.loads(params["media"]))
+        return False
+
+    def telegram(self, method, params):
+        chat_id = int(params.get("chat_id", 0))
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "getUpdates":
+            with self.lock:
+                updates, self.updates = self.updates, []
+            return updates
+        if method == "sendDocument":
+            file_id = f"tg{self.next_id()}"
+            return self.message(chat_id, document={"file_id": file_id, "file_unique_id": file_id})
+        if method == "sendMediaGroup":
+            messages = []
+            for _ in json.loads(params["media"]):
+                file_id = f"tg{self.next_id()}"
+                messages.append(self.message(chat_id, document={"file_id": file_id, "file_unique_id": file_id}))
+            return messages
+        if method == "getFile":
+            file_id = params.get("file_id", "")
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": self.file_size,
+                    "file_path": f"documents/{file_id}"}
+        if method.startswith(("send", "edit")):
+            return self.message(chat_id, text=params.get("text", ""))
+        return True
+
+    def _handler(self):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body=b"", headers=None):
+                if isinstance(body, (dict, list)):
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def reply_batch(self, body):
+                # Only the deletes sent by drive.delete_files_from_drive are understood.
+                request = email.parser.BytesParser().parsebytes(
+                    f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+                parts = []
+                for part in request.get_payload():
+                    file_id = part.get_payload().split(" ", 2)[1].split("?")[0].rsplit("/", 1)[-1]
+                    status = "204 No Content" if backend.blobs.pop(file_id, None) is not None else "404 Not Found"
+                    parts.append(f"--bench\r\nContent-Type: application/http\r\n"
+                                 f"Content-ID: <response-{part['Content-ID'][1:]}\r\n\r\nHTTP/1.1 {status}\r\n"
+                                 f"Content-Type: application/json\r\n\r\n{{}}\r\n")
+                self.reply(200, ("".join(parts) + "--bench--\r\n").encode(),
+                           {"Content-Type": "multipart/mixed; boundary=bench"})
+
+            def body(self):
+                return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            def handle_request(self):
+                url = urlparse(self.path)
+                query = {name: values[0] for name, values in parse_qs(url.query).items()}
+                body = self.body()
+                if url.path.startswith("/bot"):
+                    time.sleep(backend.telegram_latency)
+                    if random.random() < backend.telegram_errors:
+                        return self.reply(429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                                "parameters": {"retry_after": 1}})
+                    method = url.path.rsplit("/", 1)[-1]
+                    if backend.resends(method, query) and random.random() < backend.stale_file_ids:
+                        return self.reply(400, {"ok": False, "error_code": 400,
+                                                "description": "Bad Request: wrong file identifier"})
+                    return self.reply(200, {"ok": True, "result": backend.telegram(method, query)})
+                if url.path.startswith("/file/bot"):
+                    time.sleep(backend.telegram_latency)
+                    return self.reply(200, backend.content(url.path))
+                time.sleep(backend.drive_latency)
+                if random.random() < backend.drive_errors:
+                    return self.reply(500, {"error": {"code": 500, "message": "Backend Error"}})
+                if url.path == "/upload/drive/v3/files" and self.command == "POST":
+                    upload_id = str(backend.next_id())
+                    backend.uploads[upload_id] = bytearray()
+                    return self.reply(200, headers={"Location": f"{backend.url}{url.path}?upload_id={upload_id}"})
+                if url.path == "/upload/drive/v3/files" and self.command == "PUT":
+                    data = backend.uploads[query["upload_id"]]
+                    data.extend(body)
+                    total = self.headers.get("Content-Range", "/*").rsplit("/", 1)[-1]
+                    if total != "*" and int(total) == len(data):
+                        file_id = f"drive{backend.next_id()}"
+                        backend.blobs[file_id] = bytes(backend.uploads.pop(query["upload_id"]))
+                        return self.reply(200, {"id": file_id})
+                    return self.reply(308, headers={"Range": f"bytes=0-{len(data) - 1}"})
+                if url.path == "/batch/drive/v3":
+                    return self.reply_batch(body)
+                file_id = url.path.rsplit("/", 1)[-1]
+                if self.command == "DELETE":
+                    backend.blobs.pop(file_id, None)
+                    return self.reply(204)
+                if query.get("alt") == "media":
+                    return self.reply(200, backend.blobs.get(file_id, b""))
+                return self.reply(404, {"error": {"code": 404, "message": "Not found"}})
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+        return Handler
+
+
+class Stats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+        self.errors = 0
+
+    def timed(self, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                with self.lock:
+                    self.errors += 1
+                raise
+            finally:
+                with self.lock:
+                    self.samples.append(time.perf_counter() - start)
+        return wrapper
+
+    def report(self, elapsed):
+        samples = sorted(self.samples)
+
+        def percentile(q):
+            return round(samples[int(round(q * (len(samples) - 1)))] * 1000, 3) if samples else None
+        return {"count": len(samples), "errors": self.errors, "seconds": round(elapsed, 3),
+                "throughput": round(len(samples) / elapsed, 2) if elapsed else None,
+                "p50_ms": percentile(0.5), "p99_ms": percentile(0.99)}
+
+
+def configure(url, workdir, telegram_limits):
+    # Must run before main is imported: main builds the bot, dispatcher and Drive client.
+    os.environ["TELEGRAM_API_TOKEN"] = TOKEN
+    os.environ["ATTACHMENT_CACHE_DIR"] = os.path.join(workdir, "attachment_cache")
+    import db
+    import drive
+    import sender
+    from telebot import apihelper
+    db.DB_PATH = os.path.join(workdir, "reminders.db")
+    drive.API_ROOT = url + "/"
+    drive.TOKEN_PATH = os.path.join(workdir, "token.json")
+    with open(drive.TOKEN_PATH, "w") as f:
+        # Valid for the whole run, so the client never tries to refresh it against Google.
+        expiry = datetime.utcnow() + timedelta(days=1)
+        json.dump({"token": "bench", "refresh_token": "bench", "client_id": "bench", "client_secret": "bench",
+                   "expiry": expiry.strftime("%Y-%m-%dT%H:%M:%SZ")}, f)
+    apihelper.API_URL = url + "/bot{0}/{1}"
+    apihelper.FILE_URL = url + "/file/bot{0}/{1}"
+    if not telegram_limits:
+        sender.GLOBAL_RATE = sender.GLOBAL_BURST = sender.CHAT_RATE = sender.CHAT_BURST = 10 ** 6
+
+
+def seed(backend, users, reminders, periodic, attachments, due_now):
+    # `due_now` reminders per user are due immediately; the rest lie in the future.
+    import db
+    db.init_db()
+    now = int(time.time())
+    rows = []
+    for user_id in range(1, users + 1):
+        for n in range(reminders):
+            period = 3600 if n < reminders * periodic else 0
+            due_at = now - 1 if n < due_now else now + 86400 + n * 60
+            rows.append((user_id, f"reminder {n} of user {user_id}", due_at, 1 if attachments else 0,
+                         1 if period else 0, period))
+    with db.transaction() as c:
+        c.executemany("INSERT INTO reminders (user_id, description, due_at, attachment_folder, period, "
+                      "period_seconds) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        files = []
+        for reminder_id, user_id in c.execute("SELECT id, user_id FROM reminders").fetchall():
+            for n in range(attachments):
+                file_id = f"seed{reminder_id}_{n}"
+                backend.blobs[file_id] = os.urandom(backend.file_size)
+                # Half of the files were already sent once and can be resent by Telegram file_id.
+                files.append((user_id, reminder_id, file_id, f"file{n}.bin", f"tg_{file_id}" if n % 2 else None))
+        c.executemany("INSERT INTO attachments (user_id, reminder_id, file_path, file_name, telegram_file_id) "
+                      "VALUES (?, ?, ?, ?, ?)", files)
+
+
+def wait_until(condition, timeout):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def message_update(update_id, user_id, **content):
+    return {"update_id": update_id, "message": dict({"message_id": update_id, "date": int(time.time()),
+                                                     "from": user(user_id), "chat": {"id": user_id, "type": "private"}},
+                                                    **content)}
+
+
+def callback_update(update_id, user_id, data):
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user(user_id), "chat_instance": str(user_id), "data": data,
+        "message": {"message_id": update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                    "text": ""}}}
+
+
+def process(main, stats, updates):
+    from telebot import types
+    for data in updates:
+        stats.timed(main.bot.process_new_updates)([types.Update.de_json(data)])
+
+
+def bench_firing(main, args):
+    # The scheduler claims every due reminder and queues it; the delivery worker sends them.
+    # Later rounds fire the same reminders again, so their attachments come from the cache.
+    # With --digest-window every user gets the reminders of a round in one digest delivery.
+    import db
+    import reminders
+    from delivery import DeliveryWorker
+    from scheduler import ReminderScheduler
+    stats = Stats()
+    due = db.connection().execute("SELECT id, user_id FROM reminders WHERE done = 0 AND due_at <= ?",
+                                  (int(time.time()),)).fetchall()
+    for user_id in {user_id for _, user_id in due}:
+        db.set_digest_window(user_id, args.digest_window)
+
+    def finished():
+        return db.connection().execute("SELECT COUNT(*) FROM outbox WHERE state != 'pending'").fetchone()[0]
+    reminders.reminder_scheduler = ReminderScheduler(reminders.check_reminders)
+    reminders.delivery_worker = DeliveryWorker(stats.timed(reminders.deliver_reminder))
+    start = time.perf_counter()
+    reminders.reminder_scheduler.start()
+    reminders.delivery_worker.start()
+    for round_number in range(1, args.firing_rounds + 1):
+        wait_until(lambda: finished() >= len(due) * round_number, args.timeout)
+        if round_number == args.firing_rounds:
+            break
+        with db.transaction() as c:
+            c.executemany("UPDATE reminders SET done = 0, due_at = ? WHERE id = ?",
+                          [(int(time.time()), reminder_id) for reminder_id, _ in due])
+        for reminder_id, user_id in due:
+            reminders.reminder_scheduler.refresh(user_id, reminder_id)
+    report = stats.report(time.perf_counter() - start)
+    report["reminders"] = finished()
+    report["attachment_cache"] = reminders.attachment_cache.stats()
+    return report
+
+
+def bench_list_views(main, args):
+    # Users open their lists repeatedly, so most pages come from the view cache.
+    import db
+    stats = Stats()
+    updates = []
+    for n in range(args.views):
+        user_id = n % args.users + 1
+        updates.append(message_update(n + 1, user_id, text="Current tasks" if n % 2 else "Completed tasks"))
+    start = time.perf_counter()
+    process(main, stats, updates)
+    report = stats.report(time.perf_counter() - start)
+    report["view_cache"] = db.views.stats()
+    return report
+
+
+def bench_creation(main, args):
+    # /create, description, calendar day, time, one-time, no attachments: six updates per reminder.
+    stats = Stats()
+    day = date.today() + timedelta(days=1)
+    updates = []
+    for n in range(args.creations):
+        user_id = args.users + 1 + n
+        base = 100000 + n * 10
+        updates += [message_update(base, user_id, text="/create", entities=[{"type": "bot_command", "offset": 0,
+                                                                              "length": 7}]),
+                    message_update(base + 1, user_id, text=f"benchmark reminder {n}"),
+                    callback_update(base + 2, user_id, f"cbcal_0_s_d_{day.year}_{day.month}_{day.day}"),
+                    message_update(base + 3, user_id, text="12:00"),
+                    callback_update(base + 4, user_id, main.callbacks.encode(main.handle_periodic_no)),
+                    callback_update(base + 5, user_id, main.callbacks.encode(main.handle_attachment, 0))]
+    start = time.perf_counter()
+    process(main, stats, updates)
+    return stats.report(time.perf_counter() - start)
+
+
+def bench_ingest(main, args):
+    # Documents sent while a reminder is collecting attachments go through the upload queue. A
+    # share of them repeats an earlier file: half with the same Telegram file_unique_id, half
+    # with a new one but the same content.
+    import db
+    stats = Stats()
+    main.ingest_file = stats.timed(main.ingest_file)
+    updates = []
+    for n in range(args.uploads):
+        user_id = n % args.users + 1
+        main.conversations.set(user_id, user_id, attaching=True, attach_to=(user_id - 1) * args.reminders + 1)
+        file_id = unique_id = f"upload{n}"
+        if n and random.random() < args.duplicate_uploads:
+            file_id = f"upload{random.randrange(n)}"
+            unique_id = file_id if n % 2 else unique_id
+        updates.append(message_update(200000 + n, user_id, document={
+            "file_id": file_id, "file_unique_id": unique_id, "file_name": f"upload{n}.bin",
+            "mime_type": "application/octet-stream", "file_size": args.file_size}))
+    start = time.perf_counter()
+    process(main, Stats(), updates)
+    wait_until(lambda: len(stats.samples) >= args.uploads, args.timeout)
+    report = stats.report(time.perf_counter() - start)
+    report["stored_blobs"] = db.connection().execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+    return report
+
+
+def bench_deletion(main, args):
+    # Delete buttons only tombstone the files; the collector then removes them from Drive.
+    import db
+    from collector import DriveCollector
+    stats = Stats()
+    count = min(args.deletions, args.users)
+    updates = [callback_update(300000 + n, n + 1,
+                               main.callbacks.encode(main.handle_delete_query, (n + 1) * args.reminders))
+               for n in range(count)]
+    start = time.perf_counter()
+    process(main, stats, updates)
+    report = stats.report(time.perf_counter() - start)
+    collector = DriveCollector()
+    collector.collect()
+    report["collect_seconds"] = round(time.perf_counter() - start, 3)
+    report["tombstones_left"] = db.connection().execute("SELECT COUNT(*) FROM drive_tombstones").fetchone()[0]
+    return report
+
+
+def bench_cold_start(main, args):
+    # A fresh scheduler loads its schedule from a table holding `cold_start_reminders` extra
+    # open reminders spread over the next year; the rows are removed afterwards.
+    import db
+    from scheduler import STARTUP_BUDGET, ReminderScheduler
+    now = int(time.time())
+    first = 10 ** 9
+    rows = ((first + n % 100000, f"cold start {n}", now + random.randrange(365 * 86400)) for n in
+            range(args.cold_start_reminders))
+    with db.transaction() as c:
+        c.executemany("INSERT INTO reminders (user_id, description, due_at) VALUES (?, ?, ?)", rows)
+    scheduler = ReminderScheduler(lambda user_id, reminder_id: None)
+    scheduler.load()
+    report = {"reminders": db.connection().execute("SELECT COUNT(*) FROM reminders").fetchone()[0],
+              "load_seconds": round(scheduler.startup_seconds, 4), "scheduled": len(scheduler._heap),
+              "budget_seconds": STARTUP_BUDGET}
+    with db.transaction() as c:
+        c.execute("DELETE FROM reminders WHERE user_id >= ?", (first,))
+    return report
+
+
+def bench_startup(main, args):
+    # Starts each role of roles.py in a fresh process with its own fake backend and database.
+    # The child reports how long importing the role's modules took and which heavy packages it
+    # loaded; first_update_seconds runs from spawning the process to the first message the role
+    # sends: the answer to /start for the poller, and for the api role in webhook mode, and the
+    # delivery of a due reminder for the scheduler.
+    import requests
+    import roles
+    results = {}
+    for role in roles.ROLES:
+        backend = FakeBackend(args.telegram_latency / 1000)
+        backend.start()
+        workdir = tempfile.mkdtemp(prefix="bench")
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        env = dict(os.environ, BOT_MODE="webhook" if role == "api" else "polling", API_PORT=str(port),
+                   WEBHOOK_SECRET="bench")
+        update = message_update(1, 1, text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}])
+        backend.updates.append(update)
+        start = time.perf_counter()
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--startup-child", role,
+                                  "--backend-url", backend.url, "--workdir", workdir],
+                                 env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if role == "api":
+                deadline = time.time() + args.timeout
+                while time.time() < deadline:
+                    try:
+                        if requests.post(f"http://127.0.0.1:{port}/webhook", json=update,
+                                         headers={"X-Telegram-Bot-Api-Secret-Token": "bench"}).ok:
+                            break
+                    except requests.ConnectionError:
+                        pass
+                    time.sleep(0.01)
+            wait_until(lambda: backend.calls.get("sendMessage"), args.timeout)
+            first_update = time.perf_counter() - start if backend.calls.get("sendMessage") else None
+        finally:
+            child.kill()
+            child.wait()
+        try:
+            with open(os.path.join(workdir, "startup.json")) as f:
+                results[role] = json.load(f)
+        except OSError:
+            results[role] = {}
+        results[role]["first_update_seconds"] = first_update and round(first_update, 3)
+    return results
+
+
+def startup_child(args):
+    # Runs in the processes started by bench_startup. configure() imports telebot and the
+    # database module, which every role needs, so it counts towards the import time.
+    start = time.perf_counter()
+    configure(args.backend_url, args.workdir, False)
+    import roles
+    roles.load([args.startup_child])
+    report = {"import_seconds": round(time.perf_counter() - start, 3),
+              "loaded": [name for name in HEAVY_MODULES if name in sys.modules]}
+    with open(os.path.join(args.workdir, "startup.json"), "w") as f:
+        json.dump(report, f)
+    import db
+    db.init_db()
+    db.add_to_database(1, "startup", int(time.time()) - 1, 0, 0)
+    roles.run([args.startup_child])
+
+
+SCENARIOS = {
+    "firing": bench_firing,
+    "list_views": bench_list_views,
+    "creation": bench_creation,
+    "ingest": bench_ingest,
+    "deletion": bench_deletion,
+    "cold_start": bench_cold_start,
+    "startup": bench_startup,
+}
+# Packages a role should only import when it needs them.
+HEAVY_MODULES = ("googleapiclient", "google_auth_oauthlib", "fastapi", "uvicorn", "telegram_bot_calendar")
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    backend = FakeBackend(args.telegram_latency / 1000, args.telegram_errors, args.drive_latency / 1000,
+                          args.drive_errors, args.file_size, args.stale_file_ids)
+    backend.start()
+    workdir = tempfile.mkdtemp(prefix="bench")
+    configure(backend.url, workdir, args.telegram_limits)
+    seed(backend, args.users, args.reminders, args.periodic, args.attachments, args.due)
+    import main
+    main.bot.threaded = False  # handlers run inline so their latency can be measured
+    results = {}
+    for name in args.scenarios:
+        results[name] = SCENARIOS[name](main, args)
+    return {"commit": commit(), "time": int(time.time()), "config": vars(args), "results": results,
+            "telegram_calls": backend.calls}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--reminders", type=int, default=20, help="reminders per user")
+    parser.add_argument("--periodic", type=float, default=0.3, help="share of periodic reminders")
+    parser.add_argument("--attachments", type=int, default=1, help="attachments per reminder")
+    parser.add_argument("--due", type=int, default=2, help="reminders per user due at start")
+    parser.add_argument("--firing-rounds", type=int, default=2, help="times the due reminders are fired")
+    parser.add_argument("--digest-window", type=int, default=0, help="digest window of every user, in seconds")
+    parser.add_argument("--views", type=int, default=500, help="list view requests")
+    parser.add_argument("--creations", type=int, default=100, help="reminders created through the dialog")
+    parser.add_argument("--uploads", type=int, default=100, help="attachments ingested")
+    parser.add_argument("--duplicate-uploads", type=float, default=0.3, help="share of repeated attachments")
+    parser.add_argument("--deletions", type=int, default=50, help="reminders deleted, at most one per user")
+    parser.add_argument("--cold-start-reminders", type=int, default=1000000,
+                        help="extra reminders in the table when the scheduler starts")
+    parser.add_argument("--file-size", type=int, default=64 * 1024)
+    parser.add_argument("--telegram-latency", type=float, default=20, help="milliseconds")
+    parser.add_argument("--telegram-errors", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--drive-latency", type=float, default=50, help="milliseconds")
+    parser.add_argument("--drive-errors", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--stale-file-ids", type=float, default=0.5,
+                        help="share of documents Telegram refuses to resend by file_id")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep the dispatcher's rate limits")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for background work")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    parser.add_argument("--startup-child", choices=("api", "poller", "scheduler"), help=argparse.SUPPRESS)
+    parser.add_argument("--backend-url", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_args(sys.argv[1:])
+    if arguments.startup_child:
+        startup_child(arguments)
+        sys.exit()
+    # The bot's own messages go to stderr so stdout holds only the JSON results.
+    with contextlib.redirect_stdout(sys.stderr):
+        report = json.dumps(run(arguments), indent=2)
+    print(report)
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            f.write(report + "\n")
+    os._exit(0)  # scheduler, delivery and upload threads never finish on their own
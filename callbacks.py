@@ -0,0 +1,88 @@
+from metrics import HANDLER_LATENCY, timed
+
+# Compact callback_data for inline buttons: a format version, a one-character action code and
+# the action's arguments, e.g. "1d:2s" for "delete reminder 100". Integers are packed in base
+# 36. Telegram limits callback_data to 64 bytes.
+VERSION = "1"
+SEPARATOR = ":"
+MAX_LENGTH = 64
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def pack_int(value):
+    if value < 0:
+        return "-" + pack_int(-value)
+    packed = ""
+    while True:
+        value, digit = divmod(value, 36)
+        packed = DIGITS[digit] + packed
+        if not value:
+            return packed
+
+
+class CallbackRouter:
+    # Routes every callback query with one dict lookup. Actions are registered with their code
+    # and argument types (int or str); buttons get their data from encode(), so handlers receive
+    # decoded, typed arguments. Foreign formats, like the calendar's "cbcal_..." data, are routed
+    # by the part before their first "_".
+
+    def __init__(self):
+        self._actions = {}
+        self._codes = {}
+        self._prefixes = {}
+
+    def action(self, code, *types):
+        def register(func):
+            if len(code) != 1 or code in self._actions:
+                raise ValueError(f"Bad or duplicate callback action code: {code!r}")
+            self._actions[code] = (timed(HANDLER_LATENCY, func.__name__)(func), types)
+            self._codes[func] = code
+            return func
+        return register
+
+    def prefix(self, prefix):
+        def register(func):
+            self._prefixes[prefix] = timed(HANDLER_LATENCY, func.__name__)(func)
+            return func
+        return register
+
+    def encode(self, func, *args):
+        code = self._codes[func]
+        _, types = self._actions[code]
+        if len(args) != len(types):
+            raise ValueError(f"{func.__name__} takes {len(types)} callback arguments, got {len(args)}")
+        fields = []
+        for value, kind in zip(args, types):
+            field = pack_int(value) if kind is int else str(value)
+            if SEPARATOR in field:
+                raise ValueError(f"Callback argument contains {SEPARATOR!r}: {field!r}")
+            fields.append(field)
+        data = VERSION + code + SEPARATOR.join(fields)
+        if len(data.encode()) > MAX_LENGTH:
+            raise ValueError(f"Callback data longer than {MAX_LENGTH} bytes: {data!r}")
+        return data
+
+    def decode(self, data):
+        # Returns (handler, arguments), or None for data this router does not know.
+        if data[:1] == VERSION and len(data) > 1:
+            entry = self._actions.get(data[1])
+            if entry is None:
+                return None
+            func, types = entry
+            fields = data[2:].split(SEPARATOR) if len(data) > 2 else []
+            if len(fields) != len(types):
+                return None
+            try:
+                return func, [int(field, 36) if kind is int else field for field, kind in zip(fields, types)]
+            except ValueError:
+                return None
+        func = self._prefixes.get(data.split("_", 1)[0])
+        return (func, []) if func else None
+
+    def route(self, call, expired):
+        # `expired` handles buttons this router cannot decode, e.g. of an older format version.
+        route = self.decode(call.data or "")
+        if route is None:
+            return expired(call)
+        func, arguments = route
+        return func(call, *arguments)
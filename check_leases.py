@@ -0,0 +1,77 @@
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import db
+import scheduler
+
+# Runs several schedulers in separate processes against one SQLite file and checks that every
+# due reminder is delivered exactly once:
+#   python check_leases.py [reminders] [workers]
+# One extra worker claims a batch and dies without completing it; its reminders must be picked
+# up by the others once the (shortened) lease expires and they next poll the database.
+
+LEASE_SECONDS = 3
+POLL_INTERVAL = 1
+
+
+def seed(count):
+    db.init_db()
+    with db.transaction() as c:
+        c.execute("CREATE TABLE IF NOT EXISTS deliveries (reminder_id INTEGER, worker TEXT)")
+        now = int(time.time())
+        c.executemany("INSERT INTO reminders (user_id, description, due_at, attachment_folder, done, period, "
+                      "period_seconds) VALUES (?, ?, ?, NULL, 0, 0, 0)",
+                      [(i % 50, f"reminder {i}", now - i % 5) for i in range(count)])
+    db.close()
+
+
+def work(path, duration, crash):
+    db.DB_PATH = path
+    scheduler.LEASE_SECONDS = LEASE_SECONDS
+    scheduler.POLL_INTERVAL = POLL_INTERVAL
+
+    def fire(user_id, reminder_id):
+        if crash:
+            os._exit(1)
+        with db.transaction() as c:
+            c.execute("INSERT INTO deliveries (reminder_id, worker) VALUES (?, ?)",
+                      (reminder_id, reminders.worker_id))
+        reminders.complete(user_id, reminder_id)
+
+    reminders = scheduler.ReminderScheduler(fire)
+    reminders.start()
+    time.sleep(duration)
+
+
+def check(count=1000, workers=4):
+    path = os.path.join(tempfile.mkdtemp(), "reminders.db")
+    db.DB_PATH = path
+    seed(count)
+    crasher = multiprocessing.Process(target=work, args=(path, 1, True))
+    crasher.start()
+    crasher.join()
+    processes = [multiprocessing.Process(target=work, args=(path, LEASE_SECONDS + 5, False))
+                 for _ in range(workers)]
+    started = time.time()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    c = db.connection()
+    delivered = c.execute("SELECT COUNT(DISTINCT reminder_id) FROM deliveries").fetchone()[0]
+    duplicates = c.execute("SELECT COUNT(*) FROM (SELECT reminder_id FROM deliveries "
+                           "GROUP BY reminder_id HAVING COUNT(*) > 1)").fetchone()[0]
+    per_worker = c.execute("SELECT worker, COUNT(*) FROM deliveries GROUP BY worker").fetchall()
+    print(f"reminders: {count}, delivered: {delivered}, duplicates: {duplicates}, "
+          f"missed: {count - delivered}, time: {time.time() - started:.1f}s")
+    for worker, delivered_by_worker in per_worker:
+        print(f"  {worker}: {delivered_by_worker}")
+    return duplicates == 0 and delivered == count
+
+
+if __name__ == '__main__':
+    ok = check(*[int(arg) for arg in sys.argv[1:3]])
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,66 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import db
+import drive
+
+COLLECT_INTERVAL = 60
+RECONCILE_INTERVAL = 24 * 60 * 60
+# Files younger than this may belong to an upload whose attachment row is not written yet.
+RECONCILE_GRACE = 60 * 60
+
+
+class DriveCollector:
+    # Deletes Drive files in the background. Deleting an attachment or a reminder only leaves a
+    # tombstone in the database; this thread removes tombstoned files that no attachment
+    # references any more, in Drive batch requests. A periodic sweep tombstones Drive files the
+    # database does not know about, e.g. uploads that failed before their row was written.
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._woken = False
+        self._next_reconcile = time.time() + RECONCILE_GRACE
+        self._thread = None
+
+    def wake(self):
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def collect(self):
+        while True:
+            file_ids = db.collectable_drive_files(drive.BATCH_SIZE)
+            if not file_ids:
+                return
+            deleted, failed = drive.delete_files_from_drive(file_ids)
+            db.finish_drive_tombstones(deleted, failed)
+            if failed:
+                return  # retried on the next run
+
+    def reconcile(self):
+        created_before = (datetime.utcnow() - timedelta(seconds=RECONCILE_GRACE)).strftime("%Y-%m-%dT%H:%M:%S")
+        orphans = 0
+        for file_ids in drive.list_bot_files(created_before):
+            if file_ids:
+                orphans += len(db.tombstone_unreferenced_files(file_ids))
+        if orphans:
+            print(f"Found {orphans} Google Drive files without attachments.")
+
+    def run(self):
+        while True:
+            with self._cond:
+                if not self._woken:
+                    self._cond.wait(COLLECT_INTERVAL)
+                self._woken = False
+            try:
+                if time.time() >= self._next_reconcile:
+                    self._next_reconcile = time.time() + RECONCILE_INTERVAL
+                    self.reconcile()
+                self.collect()
+            except Exception as e:
+                print("Error when collecting deleted Google Drive files:", e)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
@@ -0,0 +1,642 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from metrics import db_operation
+from recurrence import catch_up
+from viewcache import ViewCache
+
+DB_PATH = 'reminders.db'
+DATE_FORMAT = '%Y-%m-%d %H:%M'
+SCHEMA_VERSION = 9
+
+REMINDER_COLUMNS = 'id, description, due_at, attachment_folder, done, period, period_seconds'
+
+_local = threading.local()
+# Cached reminder list pages; every write to a user's reminders invalidates that user's pages.
+views = ViewCache()
+
+
+def connection():
+    # One long-lived connection per thread. Autocommit mode is used so that transaction()
+    # decides where a logical operation starts and ends.
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=10, isolation_level=None, cached_statements=256)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA cache_size = -16000')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        _local.conn = conn
+        _local.depth = 0
+    return conn
+
+
+def close():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+@contextmanager
+def transaction():
+    # Nested calls join the outermost transaction, so helpers can be combined into one
+    # atomic operation by wrapping them in another transaction().
+    conn = connection()
+    c = conn.cursor()
+    if _local.depth:
+        _local.depth += 1
+        try:
+            yield c
+        finally:
+            _local.depth -= 1
+        return
+    c.execute('BEGIN IMMEDIATE')
+    _local.depth = 1
+    _local.on_commit = []
+    try:
+        yield c
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+        for func in _local.on_commit:
+            func()
+    finally:
+        _local.depth = 0
+        _local.on_commit = []
+
+
+def invalidate_views(user_id):
+    # Drops the user's cached pages once the current transaction has committed.
+    _local.on_commit.append(lambda: views.invalidate(user_id))
+
+
+def parse_date(date):
+    return int(datetime.strptime(date, DATE_FORMAT).timestamp())
+
+
+def format_date(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime(DATE_FORMAT)
+
+
+def parse_period(periodic_time):
+    try:
+        days, hours, minutes = map(int, periodic_time.split())
+        return int(timedelta(days=days, hours=hours, minutes=minutes).total_seconds())
+    except (AttributeError, ValueError, OverflowError):
+        return 0
+
+
+def parse_legacy_times(reminder_id, date, periodic_time):
+    # The due time and period of a reminder stored as text by an old version, or None if the
+    # date cannot be read: the old edit flow could store dates like "None 12:00".
+    try:
+        return parse_date(date), parse_period(periodic_time)
+    except (TypeError, ValueError, OverflowError, OSError) as e:
+        print(f"Skipping reminder {reminder_id} with an unreadable date {date!r}:", e)
+        return None
+
+
+def format_period(seconds):
+    return str(timedelta(seconds=seconds))
+
+
+def create_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS reminders
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  description TEXT,
+                  due_at INTEGER NOT NULL,
+                  attachment_folder INTEGER DEFAULT 0,
+                  done INTEGER DEFAULT 0,
+                  period INTEGER DEFAULT 0,
+                  period_seconds INTEGER DEFAULT 0,
+                  lease_owner TEXT,
+                  lease_until INTEGER)''')
+    c.execute('CREATE INDEX IF NOT EXISTS reminders_done_due ON reminders (done, due_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS reminders_user_done ON reminders (user_id, done, due_at)')
+    c.execute('''CREATE TABLE IF NOT EXISTS attachments
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  reminder_id INTEGER NOT NULL,
+                  file_path TEXT NOT NULL,
+                  file_name TEXT NOT NULL,
+                  telegram_file_id TEXT,
+                  blob_id INTEGER)''')
+    c.execute('CREATE INDEX IF NOT EXISTS attachments_reminder ON attachments (reminder_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS attachments_file ON attachments (file_path)')
+    c.execute('''CREATE TABLE IF NOT EXISTS conversation_state
+                 (chat_id INTEGER NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  data TEXT NOT NULL,
+                  updated_at INTEGER NOT NULL,
+                  PRIMARY KEY (chat_id, user_id))''')
+    # One row per occurrence to deliver. parts_sent counts the messages of the delivery
+    # (the text, then each attachment) already sent, so a retry resumes where it stopped.
+    c.execute('''CREATE TABLE IF NOT EXISTS outbox
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  idempotency_key TEXT NOT NULL UNIQUE,
+                  reminder_id INTEGER NOT NULL,
+                  user_id INTEGER NOT NULL,
+                  due_at INTEGER NOT NULL,
+                  state TEXT NOT NULL DEFAULT 'pending',
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  parts_sent INTEGER NOT NULL DEFAULT 0,
+                  next_attempt_at INTEGER NOT NULL,
+                  last_error TEXT,
+                  lease_owner TEXT,
+                  lease_until INTEGER,
+                  sent_at INTEGER,
+                  digest_of INTEGER)''')
+    c.execute('CREATE INDEX IF NOT EXISTS outbox_state_next ON outbox (state, next_attempt_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS outbox_user_state ON outbox (user_id, state)')
+    c.execute('CREATE INDEX IF NOT EXISTS outbox_digest ON outbox (digest_of)')
+    # Users with a digest window get the reminders that fall due within it in one delivery.
+    c.execute('''CREATE TABLE IF NOT EXISTS user_settings
+                 (user_id INTEGER PRIMARY KEY,
+                  digest_window INTEGER NOT NULL DEFAULT 0)''')
+    # Attachment contents, stored once per SHA-256 in Drive and shared by every attachment row
+    # linking to them; refcount is the number of those rows.
+    c.execute('''CREATE TABLE IF NOT EXISTS blobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  sha256 TEXT NOT NULL UNIQUE,
+                  drive_file_id TEXT NOT NULL,
+                  size INTEGER NOT NULL,
+                  telegram_unique_id TEXT,
+                  telegram_file_id TEXT,
+                  refcount INTEGER NOT NULL DEFAULT 0)''')
+    c.execute('CREATE INDEX IF NOT EXISTS blobs_telegram_unique ON blobs (telegram_unique_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS blobs_drive_file ON blobs (drive_file_id)')
+    # Drive files whose attachment rows were deleted. The collector removes a file from Drive
+    # once no attachment references it any more.
+    c.execute('''CREATE TABLE IF NOT EXISTS drive_tombstones
+                 (file_id TEXT PRIMARY KEY,
+                  deleted_at INTEGER NOT NULL,
+                  attempts INTEGER NOT NULL DEFAULT 0)''')
+
+
+def upgrade_epoch_times(c):
+    # Version 1 kept due dates as '%Y-%m-%d %H:%M' text and periods as 'days hours minutes'.
+    c.execute('DROP INDEX IF EXISTS reminders_done_due')
+    c.execute('DROP INDEX IF EXISTS reminders_user_done')
+    c.execute('ALTER TABLE reminders RENAME TO reminders_v1')
+    create_schema(c)
+    rows = connection().execute('SELECT id, user_id, description, due_at, attachment_folder, done, period, '
+                                'periodic_time FROM reminders_v1')
+    for row in rows:
+        times = parse_legacy_times(row[0], row[3], row[7])
+        if times is not None:
+            c.execute('INSERT INTO reminders (id, user_id, description, due_at, attachment_folder, done, period, '
+                      'period_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row[:3] + times[:1] + row[4:7] + times[1:])
+    c.execute('DROP TABLE reminders_v1')
+
+
+def upgrade_single_row_recurrence(c):
+    # Recurring reminders used to be cloned into a one-shot row (period = 1, period_seconds = 0)
+    # per occurrence. Pending clones of a recurring reminder that still exists are dropped, the
+    # remaining ones become plain one-time reminders.
+    c.execute('''DELETE FROM attachments WHERE reminder_id IN
+                 (SELECT id FROM reminders AS clone
+                  WHERE period = 1 AND period_seconds = 0 AND done = 0 AND EXISTS
+                  (SELECT 1 FROM reminders AS rule WHERE rule.user_id = clone.user_id
+                   AND rule.description IS clone.description AND rule.period_seconds > 0 AND rule.done = 0))''')
+    c.execute('''DELETE FROM reminders AS clone
+                 WHERE period = 1 AND period_seconds = 0 AND done = 0 AND EXISTS
+                 (SELECT 1 FROM reminders AS rule WHERE rule.user_id = clone.user_id
+                  AND rule.description IS clone.description AND rule.period_seconds > 0 AND rule.done = 0)''')
+    c.execute('UPDATE reminders SET period = 0 WHERE period_seconds = 0')
+
+
+def add_column(c, table, column, declaration):
+    # Tables rebuilt by an earlier upgrade already have the latest columns, and tables that do
+    # not exist yet get them from create_schema.
+    columns = [row[1] for row in c.execute(f'PRAGMA table_info({table})')]
+    if columns and column not in columns:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+
+def upgrade_telegram_file_ids(c):
+    add_column(c, 'attachments', 'telegram_file_id', 'TEXT')
+
+
+def upgrade_scheduler_leases(c):
+    add_column(c, 'reminders', 'lease_owner', 'TEXT')
+    add_column(c, 'reminders', 'lease_until', 'INTEGER')
+
+
+def upgrade_attachment_blobs(c):
+    # Existing attachments keep owning their Drive file (blob_id stays NULL).
+    add_column(c, 'attachments', 'blob_id', 'INTEGER')
+
+
+def upgrade_outbox_digests(c):
+    add_column(c, 'outbox', 'digest_of', 'INTEGER')
+
+
+UPGRADES = {
+    2: upgrade_epoch_times,
+    3: upgrade_single_row_recurrence,
+    4: upgrade_telegram_file_ids,
+    5: upgrade_scheduler_leases,
+    8: upgrade_attachment_blobs,
+    9: upgrade_outbox_digests,
+}
+
+
+def init_db():
+    with transaction() as c:
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        exists = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'reminders'").fetchone()
+        if exists:
+            for target in range(max(version, 1) + 1, SCHEMA_VERSION + 1):
+                # Versions that only add tables are handled by create_schema below.
+                if target in UPGRADES:
+                    UPGRADES[target](c)
+        create_schema(c)
+        c.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+@db_operation
+def add_to_database(user_id, description, due_at, attachment_folder, period, period_seconds=0):
+    with transaction() as c:
+        c.execute("INSERT INTO reminders (user_id, description, due_at, attachment_folder, period, period_seconds) "
+                  "VALUES (?, ?, ?, ?, ?, ?)",
+                  (user_id, description, due_at, attachment_folder, period, period_seconds))
+        invalidate_views(user_id)
+        return c.lastrowid
+
+
+def get_reminders_page(user_id, done=False, cursor=None, backward=False, limit=10):
+    # Keyset pagination over (due_at, id): open reminders ascending, completed ones descending.
+    # `cursor` is the (due_at, id) of the item the page starts after (or before, when going
+    # backward). Returns the page and whether more rows lie beyond it in that direction.
+    return views.get(user_id, (bool(done), cursor, backward, limit),
+                     lambda: read_reminders_page(user_id, done, cursor, backward, limit))
+
+
+@db_operation
+def read_reminders_page(user_id, done, cursor, backward, limit):
+    descending = bool(done) != backward
+    order = 'DESC' if descending else 'ASC'
+    query = f"SELECT {REMINDER_COLUMNS} FROM reminders WHERE user_id = ? AND done = ?"
+    params = [user_id, 1 if done else 0]
+    if cursor is not None:
+        query += f" AND (due_at, id) {'<' if descending else '>'} (?, ?)"
+        params.extend(cursor)
+    query += f" ORDER BY due_at {order}, id {order} LIMIT ?"
+    params.append(limit + 1)
+    rows = connection().execute(query, params).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, more
+
+
+@db_operation
+def get_reminder_info(user_id, reminder_id):
+    return connection().execute(f"SELECT {REMINDER_COLUMNS} FROM reminders WHERE id = ? AND user_id = ?",
+                                (reminder_id, user_id)).fetchone()
+
+
+@db_operation
+def get_latest_reminder_id(user_id):
+    return connection().execute("SELECT MAX(id) FROM reminders WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+
+@db_operation
+def update_attachment_folder(user_id, attachment_folder):
+    with transaction() as c:
+        c.execute("UPDATE reminders SET attachment_folder = ? "
+                  "WHERE id = (SELECT MAX(id) FROM reminders WHERE user_id = ?)",
+                  (attachment_folder, user_id))
+        invalidate_views(user_id)
+
+
+@db_operation
+def mark_as(user_id, reminder_id, value=1):
+    with transaction() as c:
+        c.execute("UPDATE reminders SET done = ? WHERE id = ? AND user_id = ?", (value, reminder_id, user_id))
+        invalidate_views(user_id)
+
+
+@db_operation
+def update_description(user_id, reminder_id, new_description):
+    with transaction() as c:
+        c.execute("UPDATE reminders SET description = ? WHERE id = ? AND user_id = ?",
+                  (new_description, reminder_id, user_id))
+        invalidate_views(user_id)
+
+
+@db_operation
+def update_date(user_id, reminder_id, due_at):
+    with transaction() as c:
+        c.execute("UPDATE reminders SET due_at = ? WHERE id = ? AND user_id = ?", (due_at, reminder_id, user_id))
+        invalidate_views(user_id)
+
+
+@db_operation
+def update_periodic_info(user_id, reminder_id, period_seconds, period):
+    try:
+        with transaction() as c:
+            c.execute("UPDATE reminders SET period = ?, period_seconds = ? WHERE id = ? AND user_id = ?",
+                      (period, period_seconds, reminder_id, user_id))
+            invalidate_views(user_id)
+        return True
+    except sqlite3.Error as e:
+        print("Error when updating periodic information in the database:", e)
+        return False
+
+
+@db_operation
+def add_drive_tombstones(c, file_ids):
+    c.executemany("INSERT OR IGNORE INTO drive_tombstones (file_id, deleted_at) VALUES (?, ?)",
+                  [(file_id, int(time.time())) for file_id in file_ids])
+
+
+def delete_attachments(c, condition, params):
+    # Deletes the matching attachment rows, releases their blobs and tombstones the Drive files.
+    # A blob is dropped with its last reference, so it can no longer be linked while the
+    # collector deletes its file.
+    rows = c.execute(f"SELECT file_path, blob_id FROM attachments WHERE {condition}", params).fetchall()
+    c.execute(f"DELETE FROM attachments WHERE {condition}", params)
+    blob_ids = [(blob_id,) for _, blob_id in rows if blob_id is not None]
+    c.executemany("UPDATE blobs SET refcount = refcount - 1 WHERE id = ?", blob_ids)
+    c.executemany("DELETE FROM blobs WHERE id = ? AND refcount <= 0", blob_ids)
+    add_drive_tombstones(c, {file_path for file_path, _ in rows})
+
+
+@db_operation
+def delete_reminder(user_id, reminder_id):
+    # The reminder's Drive files are tombstoned for the collector; returns False if the
+    # database delete failed.
+    try:
+        with transaction() as c:
+            delete_attachments(c, "reminder_id = ? AND user_id = ?", (reminder_id, user_id))
+            c.execute("DELETE FROM reminders WHERE id = ? AND user_id = ?", (reminder_id, user_id))
+            invalidate_views(user_id)
+        return True
+    except sqlite3.Error as e:
+        print("Error when deleting a reminder from the database:", e)
+        return False
+
+
+@db_operation
+def scheduled_reminders(since, until):
+    # Open reminders due in [since, until), read from the (done, due_at) index range only, so
+    # the cost depends on the window and not on the size of the table.
+    return connection().execute("SELECT id, user_id, due_at FROM reminders WHERE done = 0 AND due_at >= ? "
+                                "AND due_at < ?", (since, until)).fetchall()
+
+
+@db_operation
+def claim_due_reminders(owner, now, lease_seconds, limit):
+    # BEGIN IMMEDIATE takes the database write lock, so concurrent schedulers (threads or
+    # processes) never claim the same reminder. Expired leases are claimable again.
+    with transaction() as c:
+        rows = c.execute("SELECT id, user_id, due_at FROM reminders WHERE done = 0 AND due_at <= ? "
+                         "AND (lease_until IS NULL OR lease_until < ?) ORDER BY due_at LIMIT ?",
+                         (now, now, limit)).fetchall()
+        c.executemany("UPDATE reminders SET lease_owner = ?, lease_until = ? WHERE id = ?",
+                      [(owner, now + lease_seconds, row[0]) for row in rows])
+    return rows
+
+
+@db_operation
+def complete_claimed_reminder(reminder_id, owner, next_due=None, user_id=None, occurrences=()):
+    # Marks a claimed reminder done, or moves a recurring one to `next_due`, releases the lease
+    # and queues one outbox delivery per due time in `occurrences`, all in one transaction.
+    # Returns False if the lease had already been lost to another worker.
+    with transaction() as c:
+        if next_due is None:
+            c.execute("UPDATE reminders SET done = 1, lease_owner = NULL, lease_until = NULL "
+                      "WHERE id = ? AND lease_owner = ?", (reminder_id, owner))
+        else:
+            c.execute("UPDATE reminders SET due_at = ?, lease_owner = NULL, lease_until = NULL "
+                      "WHERE id = ? AND lease_owner = ?", (next_due, reminder_id, owner))
+        if c.rowcount != 1:
+            return False
+        invalidate_views(user_id)
+        window = c.execute("SELECT digest_window FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
+        window = window[0] if window else 0
+        for due in occurrences:
+            if enqueue_delivery(c, reminder_id, user_id, due, window):
+                claim_digest_reminders(c, user_id, owner, due + window, window)
+        return True
+
+
+def enqueue_delivery(c, reminder_id, user_id, due, digest_window):
+    # The key makes enqueueing the same occurrence twice a no-op. With a digest window the
+    # delivery joins the user's open digest, one that has not been attempted yet, or opens one
+    # that goes out right away; its first row's id is the digest's id. Returns True if it
+    # opened a digest.
+    if not digest_window:
+        c.execute("INSERT OR IGNORE INTO outbox (idempotency_key, reminder_id, user_id, due_at, next_attempt_at) "
+                  "VALUES (?, ?, ?, ?, ?)", (f"{reminder_id}:{due}", reminder_id, user_id, due, due))
+        return False
+    digest = c.execute("SELECT id, next_attempt_at FROM outbox WHERE user_id = ? AND state = 'pending' "
+                       "AND digest_of = id AND attempts = 0 AND lease_owner IS NULL", (user_id,)).fetchone()
+    if digest is None:
+        c.execute("INSERT OR IGNORE INTO outbox (idempotency_key, reminder_id, user_id, due_at, next_attempt_at) "
+                  "VALUES (?, ?, ?, ?, ?)", (f"{reminder_id}:{due}", reminder_id, user_id, due, due))
+        if not c.rowcount:
+            return False
+        c.execute("UPDATE outbox SET digest_of = id WHERE id = ?", (c.lastrowid,))
+        return True
+    c.execute("INSERT OR IGNORE INTO outbox (idempotency_key, reminder_id, user_id, due_at, next_attempt_at, "
+              "digest_of) VALUES (?, ?, ?, ?, ?, ?)",
+              (f"{reminder_id}:{due}", reminder_id, user_id, due, digest[1], digest[0]))
+    return False
+
+
+def claim_digest_reminders(c, user_id, owner, until, digest_window):
+    # Completes the user's other reminders that are already due, up to `until`, so they join
+    # the digest just opened instead of each opening their own. Reminders still in the future
+    # are left alone, so nothing arrives early. Reminders leased by another worker are left to
+    # it; those this worker has claimed but not fired yet are taken, and are skipped when it
+    # reaches them since they are done or no longer due.
+    now = int(time.time())
+    rows = c.execute("SELECT id, due_at, period_seconds FROM reminders WHERE user_id = ? AND done = 0 "
+                     "AND due_at <= ? AND (lease_until IS NULL OR lease_until < ? OR lease_owner = ?)",
+                     (user_id, min(until, now), now, owner)).fetchall()
+    for reminder_id, due, period_seconds in rows:
+        if not period_seconds:
+            c.execute("UPDATE reminders SET done = 1, lease_owner = NULL, lease_until = NULL WHERE id = ?",
+                      (reminder_id,))
+            occurrences = [due]
+        else:
+            occurrences, next_due = catch_up(due, period_seconds, now)
+            c.execute("UPDATE reminders SET due_at = ?, lease_owner = NULL, lease_until = NULL WHERE id = ?",
+                      (next_due, reminder_id))
+        for occurrence in occurrences:
+            enqueue_delivery(c, reminder_id, user_id, occurrence, digest_window)
+
+
+@db_operation
+def claim_deliveries(owner, now, lease_seconds, limit):
+    # Returns up to `limit` deliveries, each a list of (id, reminder_id, user_id, due_at,
+    # attempts, parts_sent) rows: one row, or every row of a digest in due order.
+    with transaction() as c:
+        heads = c.execute("SELECT id, digest_of FROM outbox WHERE state = 'pending' AND next_attempt_at <= ? "
+                          "AND (lease_until IS NULL OR lease_until < ?) AND (digest_of IS NULL OR digest_of = id) "
+                          "ORDER BY next_attempt_at LIMIT ?", (now, now, limit)).fetchall()
+        deliveries = []
+        for delivery_id, digest_of in heads:
+            if digest_of is None:
+                rows = c.execute("SELECT id, reminder_id, user_id, due_at, attempts, parts_sent FROM outbox "
+                                 "WHERE id = ?", (delivery_id,)).fetchall()
+            else:
+                rows = c.execute("SELECT id, reminder_id, user_id, due_at, attempts, parts_sent FROM outbox "
+                                 "WHERE digest_of = ? AND state = 'pending' ORDER BY due_at, id",
+                                 (digest_of,)).fetchall()
+            c.executemany("UPDATE outbox SET lease_owner = ?, lease_until = ? WHERE id = ?",
+                          [(owner, now + lease_seconds, row[0]) for row in rows])
+            deliveries.append(rows)
+    return deliveries
+
+
+@db_operation
+def next_delivery_time():
+    # Deliveries leased by another worker only become claimable after their lease ends.
+    return connection().execute("SELECT MIN(MAX(next_attempt_at, COALESCE(lease_until + 1, 0))) FROM outbox "
+                                "WHERE state = 'pending'").fetchone()[0]
+
+
+# The functions below take the ids of all rows of a delivery; a digest's rows share its state.
+
+@db_operation
+def record_delivery_progress(delivery_ids, owner, parts_sent):
+    with transaction() as c:
+        c.executemany("UPDATE outbox SET parts_sent = ? WHERE id = ? AND lease_owner = ?",
+                      [(parts_sent, delivery_id, owner) for delivery_id in delivery_ids])
+
+
+@db_operation
+def finish_delivery(delivery_ids, owner, now):
+    with transaction() as c:
+        c.executemany("UPDATE outbox SET state = 'sent', sent_at = ?, attempts = attempts + 1, lease_owner = NULL, "
+                      "lease_until = NULL WHERE id = ? AND lease_owner = ?",
+                      [(now, delivery_id, owner) for delivery_id in delivery_ids])
+
+
+@db_operation
+def fail_delivery(delivery_ids, owner, error, retry_at=None):
+    # Without `retry_at` the delivery is dead-lettered and kept for inspection.
+    with transaction() as c:
+        c.executemany("UPDATE outbox SET state = ?, attempts = attempts + 1, last_error = ?, next_attempt_at = "
+                      "COALESCE(?, next_attempt_at), lease_owner = NULL, lease_until = NULL "
+                      "WHERE id = ? AND lease_owner = ?",
+                      [('pending' if retry_at else 'dead', error, retry_at, delivery_id, owner)
+                       for delivery_id in delivery_ids])
+
+
+@db_operation
+def get_digest_window(user_id):
+    row = connection().execute("SELECT digest_window FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+@db_operation
+def set_digest_window(user_id, seconds):
+    with transaction() as c:
+        c.execute("INSERT INTO user_settings (user_id, digest_window) VALUES (?, ?) "
+                  "ON CONFLICT (user_id) DO UPDATE SET digest_window = excluded.digest_window", (user_id, seconds))
+
+
+@db_operation
+def get_all_files_info_from_database(reminder_id):
+    return connection().execute("SELECT file_path, file_name, telegram_file_id FROM attachments "
+                                "WHERE reminder_id = ? ORDER BY id", (reminder_id,)).fetchall()
+
+
+@db_operation
+def find_blob(sha256=None, telegram_unique_id=None):
+    # Returns the blob id, or None.
+    if sha256 is not None:
+        row = connection().execute("SELECT id FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+    else:
+        row = connection().execute("SELECT id FROM blobs WHERE telegram_unique_id = ?",
+                                   (telegram_unique_id,)).fetchone()
+    return row[0] if row else None
+
+
+@db_operation
+def link_blob(user_id, reminder_id, blob_id, file_name):
+    # Attaches an existing blob to a reminder. Returns False if the blob was released meanwhile.
+    with transaction() as c:
+        blob = c.execute("SELECT drive_file_id, telegram_file_id FROM blobs WHERE id = ?", (blob_id,)).fetchone()
+        if blob is None:
+            return False
+        c.execute("INSERT INTO attachments (user_id, reminder_id, file_path, file_name, telegram_file_id, blob_id) "
+                  "VALUES (?, ?, ?, ?, ?, ?)", (user_id, reminder_id, blob[0], file_name, blob[1], blob_id))
+        c.execute("UPDATE blobs SET refcount = refcount + 1 WHERE id = ?", (blob_id,))
+        return True
+
+
+@db_operation
+def save_blob(user_id, reminder_id, sha256, drive_file_id, size, file_name, telegram_unique_id=None,
+              telegram_file_id=None):
+    # Records a freshly uploaded blob and attaches it. If a blob with the same content is already
+    # stored, that blob is used and this Drive file is tombstoned.
+    with transaction() as c:
+        c.execute("INSERT OR IGNORE INTO blobs (sha256, drive_file_id, size, telegram_unique_id, telegram_file_id) "
+                  "VALUES (?, ?, ?, ?, ?)", (sha256, drive_file_id, size, telegram_unique_id, telegram_file_id))
+        if not c.rowcount:
+            add_drive_tombstones(c, [drive_file_id])
+        link_blob(user_id, reminder_id, find_blob(sha256), file_name)
+
+
+@db_operation
+def update_telegram_file_id(file_path, telegram_file_id):
+    with transaction() as c:
+        c.execute("UPDATE attachments SET telegram_file_id = ? WHERE file_path = ?", (telegram_file_id, file_path))
+        c.execute("UPDATE blobs SET telegram_file_id = ? WHERE drive_file_id = ?", (telegram_file_id, file_path))
+
+
+@db_operation
+def delete_file_from_database(user_id, file_id, reminder_id):
+    try:
+        with transaction() as c:
+            delete_attachments(c, "file_path = ? AND reminder_id = ? AND user_id = ?", (file_id, reminder_id, user_id))
+        return True
+    except sqlite3.Error as e:
+        print("Error when deleting a file from the database:", e)
+        return False
+
+
+@db_operation
+def collectable_drive_files(limit):
+    # Tombstoned files that no attachment references. Tombstones of files that are referenced
+    # again are dropped.
+    with transaction() as c:
+        c.execute("DELETE FROM drive_tombstones WHERE EXISTS "
+                  "(SELECT 1 FROM attachments WHERE attachments.file_path = drive_tombstones.file_id)")
+        return [row[0] for row in c.execute("SELECT file_id FROM drive_tombstones ORDER BY attempts, deleted_at "
+                                            "LIMIT ?", (limit,))]
+
+
+@db_operation
+def finish_drive_tombstones(deleted, failed):
+    with transaction() as c:
+        c.executemany("DELETE FROM drive_tombstones WHERE file_id = ? AND NOT EXISTS "
+                      "(SELECT 1 FROM attachments WHERE file_path = ?)", [(file_id, file_id) for file_id in deleted])
+        c.executemany("UPDATE drive_tombstones SET attempts = attempts + 1 WHERE file_id = ?",
+                      [(file_id,) for file_id in failed])
+
+
+@db_operation
+def tombstone_unreferenced_files(file_ids):
+    # Used by the reconcile sweep, one page of Drive file ids at a time, for files the database
+    # does not know about.
+    with transaction() as c:
+        placeholders = ", ".join("?" * len(file_ids))
+        known = {row[0] for row in c.execute(f"SELECT file_path FROM attachments WHERE file_path IN ({placeholders})",
+                                             file_ids)}
+        orphans = [file_id for file_id in file_ids if file_id not in known]
+        add_drive_tombstones(c, orphans)
+    return orphans
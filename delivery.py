@@ -0,0 +1,120 @@
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot.apihelper import ApiTelegramException
+
+import db
+from metrics import REMINDERS_FAILED, REMINDERS_FIRED
+
+DELIVERY_WORKERS = 8
+LEASE_SECONDS = 300
+POLL_INTERVAL = 5
+MAX_ATTEMPTS = 8
+RETRY_BASE = 30
+RETRY_MAX = 60 * 60
+
+
+def retry_delay(attempts):
+    # Exponential back-off with jitter, so deliveries that failed together do not retry together.
+    return min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX) * random.uniform(0.5, 1)
+
+
+def is_permanent(error):
+    # The user blocked the bot or the chat no longer exists: retrying cannot help.
+    return isinstance(error, ApiTelegramException) and error.error_code in (400, 403)
+
+
+class Delivery:
+    # One outbox row, or the rows of a digest; the attributes of the first row describe the
+    # delivery, reminder_ids lists the reminders of a digest in due order.
+
+    def __init__(self, worker, rows):
+        self.id, self.reminder_id, self.user_id, self.due_at, self.attempts, self.parts_sent = rows[0]
+        self.ids = [row[0] for row in rows]
+        self.reminder_ids = [row[1] for row in rows]
+        self.digest = len(rows) > 1
+        self._worker = worker
+
+    def sent(self, parts):
+        # Records that the first `parts` messages of this delivery went out.
+        self.parts_sent = parts
+        db.record_delivery_progress(self.ids, self._worker.worker_id, parts)
+
+
+class DeliveryWorker:
+    # Drains the outbox table. Deliveries are claimed with a lease like reminders are, and each
+    # runs on its own pool thread, so a slow or failing send only holds up its own delivery.
+    # Failed attempts are retried with back-off; after MAX_ATTEMPTS, or on a permanent error,
+    # the delivery is dead-lettered.
+
+    def __init__(self, deliver, workers=DELIVERY_WORKERS, worker_id=None):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._deliver = deliver
+        self._workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='delivery')
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._woken = False
+        self._thread = None
+
+    def wake(self):
+        # Called after deliveries were queued so they go out without waiting for the next poll.
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def _wait(self, timeout):
+        with self._cond:
+            if not self._woken:
+                self._cond.wait(timeout)
+            self._woken = False
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._in_flight >= self._workers:
+                    self._cond.wait()
+                free = self._workers - self._in_flight
+            now = int(time.time())
+            # This is the only thread draining the outbox, so a database error must not end it.
+            try:
+                deliveries = db.claim_deliveries(self.worker_id, now, LEASE_SECONDS, free)
+                next_time = db.next_delivery_time() if len(deliveries) < free else None
+            except Exception as e:
+                print("Error when claiming deliveries:", e)
+                deliveries, next_time = [], None
+            with self._cond:
+                self._in_flight += len(deliveries)
+            for rows in deliveries:
+                self._executor.submit(self._attempt, Delivery(self, rows))
+            if len(deliveries) < free:
+                self._wait(POLL_INTERVAL if next_time is None else min(POLL_INTERVAL, max(next_time - now, 0.1)))
+
+    def _attempt(self, delivery):
+        try:
+            self._deliver(delivery)
+            db.finish_delivery(delivery.ids, self.worker_id, int(time.time()))
+            REMINDERS_FIRED.inc(len(delivery.ids))
+        except Exception as e:
+            attempts = delivery.attempts + 1
+            dead = is_permanent(e) or attempts >= MAX_ATTEMPTS
+            REMINDERS_FAILED.labels("dead" if dead else "retry").inc()
+            if dead:
+                print(f"Giving up on delivery {delivery.id} after {attempts} attempts:", e)
+                db.fail_delivery(delivery.ids, self.worker_id, str(e))
+            else:
+                db.fail_delivery(delivery.ids, self.worker_id, str(e), int(time.time() + retry_delay(attempts)))
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._woken = True
+                self._cond.notify_all()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
@@ -0,0 +1,178 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from metrics import DRIVE_BYTES, DRIVE_LATENCY, timed
+
+# The Google client libraries take a good part of a second to import and most updates never
+# touch Drive, so they are imported on first use rather than here.
+
+SCOPES = ["https://www.googleapis.com/auth/drive", "https://www.googleapis.com/auth/drive.file"]
+TOKEN_PATH = "token.json"
+CREDENTIALS_PATH = "credentials.json"
+# Points the client at another Drive-compatible server, e.g. the fake one in bench.py.
+API_ROOT = os.getenv("DRIVE_API_ROOT")
+REFRESH_MARGIN = 300
+# Resumable upload chunks must be a multiple of 256 KB.
+CHUNK_SIZE = 4 * 1024 * 1024
+# Drive accepts at most 100 calls in one batch request.
+BATCH_SIZE = 100
+LIST_PAGE_SIZE = 500
+# Marks the files uploaded by the bot, so the reconcile sweep never touches anything else.
+APP_PROPERTY = "reminder_bot"
+
+
+class DriveClient:
+    # Process-wide Drive client. The discovery document is parsed and the service built once;
+    # httplib2 is not thread-safe, so every thread executes requests through its own
+    # AuthorizedHttp over the shared credentials.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._creds = None
+        self._service = None
+        self._token = None
+        self._refresher = None
+
+    def _load_credentials(self):
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        creds = None
+        if os.path.exists(TOKEN_PATH):
+            # Remembered so _save_token only rewrites the file when the token changed.
+            with open(TOKEN_PATH) as f:
+                self._token = f.read()
+            creds = Credentials.from_authorized_user_info(json.loads(self._token), SCOPES)
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
+                creds = flow.run_local_server(port=0)
+        self._creds = creds
+        self._save_token()
+
+    def _save_token(self):
+        token = self._creds.to_json()
+        if token != self._token:
+            with open(TOKEN_PATH, "w") as f:
+                f.write(token)
+            self._token = token
+
+    def _refresh(self):
+        from google.auth.transport.requests import Request
+        with self._lock:
+            self._creds.refresh(Request())
+            self._save_token()
+
+    def _refresh_loop(self):
+        while True:
+            expiry = self._creds.expiry
+            delay = (expiry - datetime.utcnow()).total_seconds() - REFRESH_MARGIN if expiry else REFRESH_MARGIN
+            time.sleep(max(delay, 5))
+            try:
+                self._refresh()
+            except Exception as e:
+                print("Error when refreshing Google Drive credentials:", e)
+
+    def service(self):
+        if self._service is None:
+            with self._lock:
+                if self._service is None:
+                    from googleapiclient import discovery_cache
+                    from googleapiclient.discovery import build, build_from_document
+                    self._load_credentials()
+                    if API_ROOT:
+                        document = json.loads(discovery_cache.get_static_doc("drive", "v3"))
+                        document["rootUrl"] = API_ROOT
+                        self._service = build_from_document(document, credentials=self._creds)
+                    else:
+                        self._service = build("drive", "v3", credentials=self._creds, cache_discovery=False)
+                    self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+                    self._refresher.start()
+        return self._service
+
+    def http(self):
+        self.service()
+        http = getattr(self._local, "http", None)
+        if http is None:
+            from google_auth_httplib2 import AuthorizedHttp
+            from googleapiclient.http import build_http
+            # build_http() keeps 308 out of httplib2's redirect codes; resumable uploads answer
+            # every chunk but the last with a 308 that has no Location.
+            http = AuthorizedHttp(self._creds, http=build_http())
+            self._local.http = http
+        return http
+
+    def execute(self, request):
+        return request.execute(http=self.http())
+
+
+client = DriveClient()
+
+
+@timed(DRIVE_LATENCY, "upload")
+def upload_stream_to_drive(stream, name, mimetype=None, size=None):
+    # Returns the file id with the SHA-256 hex digest and size of the uploaded contents.
+    from media import StreamUpload
+    media = StreamUpload(stream, mimetype, size)
+    request = client.service().files().create(body={"name": name, "appProperties": {APP_PROPERTY: "1"}},
+                                              media_body=media, fields="id")
+    file = client.execute(request)
+    DRIVE_BYTES.labels("upload").inc(media.bytes_read)
+    return file.get("id"), media.sha256.hexdigest(), media.bytes_read
+
+
+@timed(DRIVE_LATENCY, "download")
+def download_file_from_drive(file_id, fh):
+    # Writes the contents of the file into the binary file object `fh`.
+    from googleapiclient.http import MediaIoBaseDownload
+    request = client.service().files().get_media(fileId=file_id)
+    # MediaIoBaseDownload sends its chunk requests through request.http.
+    request.http = client.http()
+    downloader = MediaIoBaseDownload(fh, request, chunksize=CHUNK_SIZE)
+    done = False
+    while done is False:
+        status, done = downloader.next_chunk()
+    DRIVE_BYTES.labels("download").inc(fh.tell())
+
+
+@timed(DRIVE_LATENCY, "delete")
+def delete_files_from_drive(file_ids):
+    # Deletes up to BATCH_SIZE files in one batch HTTP request. Returns the ids that are gone
+    # (deleted now or already missing) and the ids that failed.
+    from googleapiclient.errors import HttpError
+    deleted, failed = [], []
+
+    def callback(request_id, response, exception):
+        file_id = file_ids[int(request_id)]
+        if exception is None or isinstance(exception, HttpError) and exception.resp.status == 404:
+            deleted.append(file_id)
+        else:
+            print("Error when deleting a file from Google Drive:", exception)
+            failed.append(file_id)
+
+    batch = client.service().new_batch_http_request(callback=callback)
+    for number, file_id in enumerate(file_ids):
+        batch.add(client.service().files().delete(fileId=file_id), request_id=str(number))
+    batch.execute(http=client.http())
+    return deleted, failed
+
+
+def list_bot_files(created_before):
+    # Yields pages of ids of the files this bot uploaded (marked with APP_PROPERTY) that were
+    # created before `created_before`, an RFC 3339 timestamp.
+    query = (f"appProperties has {{ key='{APP_PROPERTY}' and value='1' }} and trashed = false "
+             f"and createdTime < '{created_before}'")
+    page_token = None
+    while True:
+        response = client.execute(client.service().files().list(
+            q=query, fields="nextPageToken, files(id)", pageSize=LIST_PAGE_SIZE, pageToken=page_token))
+        yield [file["id"] for file in response.get("files", [])]
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return
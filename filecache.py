@@ -0,0 +1,117 @@
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+from metrics import ATTACHMENT_CACHE_BYTES, ATTACHMENT_CACHE_REQUESTS, child
+
+CACHE_DIR = os.getenv("ATTACHMENT_CACHE_DIR", "attachment_cache")
+CACHE_BYTES = int(os.getenv("ATTACHMENT_CACHE_BYTES", 512 * 1024 * 1024))
+SAFE_KEY = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+class AttachmentCache:
+    # Size-bounded on-disk LRU cache of attachment contents, keyed by Drive file id. Files are
+    # written to a temporary name and renamed into place, so readers never see partial files;
+    # concurrent misses on one key share a single fetch. Evicted files that are still open stay
+    # readable until closed.
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_BYTES):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._fetching = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        # Files left by an earlier run, least recently used first.
+        files = []
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            if name.startswith("."):
+                os.remove(path)  # temporary file of an interrupted fetch
+            else:
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._size += size
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key)
+
+    def _evict(self):
+        while self._size > self._max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+        ATTACHMENT_CACHE_BYTES.set(self._size)
+
+    def open(self, file_id, fetch):
+        # Returns an open binary file with the contents of `file_id`; on a miss `fetch(file)`
+        # writes them into the given file object.
+        key = file_id if SAFE_KEY.match(file_id) else file_id.encode().hex()
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    try:
+                        file = open(self._path(key), "rb")
+                    except FileNotFoundError:
+                        self._size -= self._entries.pop(key)
+                    else:
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        child(ATTACHMENT_CACHE_REQUESTS, "hit").inc()
+                        os.utime(self._path(key))
+                        return file
+                event = self._fetching.get(key)
+                if event is None:
+                    event = self._fetching[key] = threading.Event()
+                    self.misses += 1
+                    child(ATTACHMENT_CACHE_REQUESTS, "miss").inc()
+                    break
+            event.wait()
+        try:
+            return self._fetch(key, fetch)
+        finally:
+            with self._lock:
+                del self._fetching[key]
+            event.set()
+
+    def _fetch(self, key, fetch):
+        fd, temporary = tempfile.mkstemp(dir=self._directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                fetch(file)
+            size = os.path.getsize(temporary)
+            file = open(temporary, "rb")
+        except BaseException:
+            os.remove(temporary)
+            raise
+        if size > self._max_bytes:
+            os.remove(temporary)  # too big to keep; the open file stays readable
+            return file
+        os.replace(temporary, self._path(key))
+        with self._lock:
+            self._entries[key] = size
+            self._size += size
+            self._evict()
+        return file
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else None,
+                    "evictions": self.evictions, "files": len(self._entries), "bytes": self._size}
@@ -0,0 +1,53 @@
+import hashlib
+
+from googleapiclient.http import MediaUpload
+
+from drive import CHUNK_SIZE
+
+
+class StreamUpload(MediaUpload):
+    # Resumable upload from a forward-only stream (e.g. an HTTP response). Pass its size when
+    # known: without it the end of the upload is only found by a short read, and a file that
+    # fills its last chunk exactly ends with an empty request Drive does not accept.
+    # Only the chunk Drive has not acknowledged yet is held in memory. The contents are hashed
+    # as they are read, so the SHA-256 is known once the upload completes.
+
+    def __init__(self, stream, mimetype, size=None, chunksize=CHUNK_SIZE):
+        super().__init__()
+        self._stream = stream
+        self._mimetype = mimetype or "application/octet-stream"
+        self._size = size
+        self._chunksize = chunksize
+        self._buffer = b""
+        self._offset = 0
+        self.bytes_read = 0
+        self.sha256 = hashlib.sha256()
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def has_stream(self):
+        return False
+
+    def getbytes(self, begin, length):
+        if begin < self._offset:
+            raise ValueError("Stream upload cannot rewind before the last acknowledged chunk.")
+        self._buffer = self._buffer[begin - self._offset:]
+        self._offset = begin
+        while len(self._buffer) < length:
+            data = self._stream.read(length - len(self._buffer))
+            if not data:
+                break
+            self.bytes_read += len(data)
+            self.sha256.update(data)
+            self._buffer += data
+        return self._buffer[:length]
@@ -0,0 +1,87 @@
+import functools
+import threading
+import time
+
+import requests
+from prometheus_client import Counter, Gauge, Histogram
+
+# Process-wide Prometheus metrics, exposed by server.py at /metrics. Labelled children are
+# resolved once per label value and cached, so recording a sample in a hot path costs a dict
+# lookup and a locked add.
+
+SCHEDULER_LAG = Histogram("reminder_scheduler_lag_seconds", "Time between a reminder's due time and its firing.",
+                          buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600))
+SCHEDULER_STARTUP = Gauge("reminder_scheduler_startup_seconds", "Time the scheduler took to load its schedule.")
+REMINDERS_DUE = Counter("reminders_due_total", "Reminders claimed by the scheduler.")
+REMINDERS_FIRED = Counter("reminders_fired_total", "Reminder deliveries sent.")
+REMINDERS_FAILED = Counter("reminders_failed_total", "Failed reminder delivery attempts.", ["outcome"])
+TELEGRAM_LATENCY = Histogram("telegram_request_seconds", "Telegram Bot API request latency.", ["method"])
+TELEGRAM_RATE_LIMITED = Counter("telegram_rate_limited_total", "Telegram requests answered with 429.", ["method"])
+DRIVE_LATENCY = Histogram("drive_request_seconds", "Google Drive transfer latency.", ["operation"],
+                          buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+DRIVE_BYTES = Counter("drive_bytes_total", "Bytes transferred to and from Google Drive.", ["operation"])
+DB_LATENCY = Histogram("sqlite_operation_seconds", "SQLite operation latency.", ["operation"],
+                       buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1))
+HANDLER_LATENCY = Histogram("telegram_handler_seconds", "Bot handler latency.", ["handler"])
+ATTACHMENT_CACHE_REQUESTS = Counter("attachment_cache_requests_total", "Attachment cache lookups.", ["result"])
+ATTACHMENT_CACHE_BYTES = Gauge("attachment_cache_bytes", "Bytes held in the attachment cache.")
+VIEW_CACHE_REQUESTS = Counter("reminder_view_cache_requests_total", "Reminder list cache lookups.", ["result"])
+
+_children = {}
+_local = threading.local()
+
+
+def child(metric, label):
+    key = (metric, label)
+    series = _children.get(key)
+    if series is None:
+        series = _children[key] = metric.labels(label)
+    return series
+
+
+def timed(metric, label):
+    # Decorator recording the duration of every call under `label`.
+    def decorate(func):
+        series = child(metric, label)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                series.observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def db_operation(func):
+    return timed(DB_LATENCY, func.__name__)(func)
+
+
+def send_telegram_request(method, url, **kwargs):
+    # Installed as telebot.apihelper.CUSTOM_REQUEST_SENDER; every Bot API call goes through it.
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = _local.session = requests.Session()
+    name = url.rsplit("/", 1)[-1]
+    start = time.perf_counter()
+    response = session.request(method, url, **kwargs)
+    child(TELEGRAM_LATENCY, name).observe(time.perf_counter() - start)
+    if response.status_code == 429:
+        child(TELEGRAM_RATE_LIMITED, name).inc()
+    return response
+
+
+def instrument_requests():
+    from telebot import apihelper
+    apihelper.CUSTOM_REQUEST_SENDER = send_telegram_request
+
+
+def instrument_bot(bot):
+    # Wraps the handlers registered so far; call it after all handlers are defined.
+    instrument_requests()
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for handler in handlers:
+            function = handler["function"]
+            handler["function"] = timed(HANDLER_LATENCY, function.__name__)(function)
@@ -0,0 +1,80 @@
+import re
+import sqlite3
+import sys
+
+import db
+
+# One-shot migration from the legacy per-user layout (user_{id} and
+# attachments_{user}_{reminder} tables) into the shared reminders/attachments tables.
+
+USER_TABLE = re.compile(r'^user_(\d+)$')
+ATTACHMENTS_TABLE = re.compile(r'^attachments_(\d+)_(\d+)$')
+
+
+def legacy_tables(c):
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND (name LIKE 'user\\_%' ESCAPE '\\' "
+              "OR name LIKE 'attachments\\_%' ESCAPE '\\')")
+    users, attachments = {}, {}
+    for (name,) in c.fetchall():
+        match = USER_TABLE.match(name)
+        if match:
+            users[int(match.group(1))] = name
+            continue
+        match = ATTACHMENTS_TABLE.match(name)
+        if match:
+            attachments[(int(match.group(1)), int(match.group(2)))] = name
+    return users, attachments
+
+
+def migrate_user(c, user_id, table_name, attachment_tables):
+    c.execute(f"SELECT id, description, date, attachment_folder, done, period, periodic_time FROM {table_name}")
+    for row in c.fetchall():
+        times = db.parse_legacy_times(row[0], row[2], row[6])
+        if times is None:
+            # Its attachment table, if any, is dropped with the other orphaned ones.
+            continue
+        c.execute("INSERT INTO reminders (user_id, description, due_at, attachment_folder, done, period, "
+                  "period_seconds) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                  (user_id, row[1], times[0]) + row[3:6] + (times[1],))
+        reminder_id = c.lastrowid
+        attachments_name = attachment_tables.pop((user_id, row[0]), None)
+        if attachments_name is not None:
+            c.execute(f"INSERT INTO attachments (user_id, reminder_id, file_path, file_name) "
+                      f"SELECT ?, ?, file_path, file_name FROM {attachments_name}", (user_id, reminder_id))
+            c.execute(f"DROP TABLE {attachments_name}")
+    c.execute(f"DROP TABLE {table_name}")
+
+
+def migrate(batch_size=200):
+    # Each batch of users is copied and its legacy tables dropped in a single transaction,
+    # so an interrupted run can simply be restarted.
+    db.init_db()
+    c = db.connection().cursor()
+    users, attachment_tables = legacy_tables(c)
+    user_ids = sorted(users)
+    migrated = 0
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        try:
+            with db.transaction() as c:
+                for user_id in batch:
+                    migrate_user(c, user_id, users[user_id], attachment_tables)
+                # Legacy tables still hold one cloned row per occurrence of a recurring
+                # reminder; the schema upgrade that folds them already ran in init_db().
+                db.upgrade_single_row_recurrence(c)
+            migrated += len(batch)
+        except sqlite3.Error as e:
+            print("Error when migrating legacy reminder tables:", e)
+            break
+    else:
+        # Attachment tables whose reminder no longer exists.
+        with db.transaction() as c:
+            for name in attachment_tables.values():
+                c.execute(f"DROP TABLE {name}")
+    return migrated
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        db.DB_PATH = sys.argv[1]
+    print(f"Migrated {migrate()} users.")
@@ -0,0 +1,24 @@
+import os
+
+# What to do with occurrences of a recurring reminder that were missed while the bot was down:
+#   once - deliver a single reminder for all of them
+#   all  - deliver one reminder per missed occurrence
+#   skip - deliver nothing unless the latest occurrence is less than CATCH_UP_GRACE seconds old
+CATCH_UP_POLICIES = ('once', 'all', 'skip')
+
+
+def catch_up(due_at, period_seconds, now, policy=None):
+    # Returns the due times to deliver now and the next occurrence after `now`.
+    policy = policy or os.getenv('CATCH_UP_POLICY', 'once')
+    if policy not in CATCH_UP_POLICIES:
+        policy = 'once'
+    missed = (now - due_at) // period_seconds + 1 if now >= due_at else 0
+    next_due = due_at + missed * period_seconds
+    if missed == 0:
+        return [], next_due
+    latest = next_due - period_seconds
+    if policy == 'all':
+        return [due_at + i * period_seconds for i in range(missed)], next_due
+    if policy == 'skip' and now - latest > int(os.getenv('CATCH_UP_GRACE', 60)):
+        return [], next_due
+    return [latest], next_due
@@ -0,0 +1,164 @@
+import contextlib
+import os
+import time
+
+import telebot
+from dotenv import load_dotenv
+from telebot import types
+
+from collector import DriveCollector
+from db import get_all_files_info_from_database, get_reminder_info, update_telegram_file_id
+from delivery import DeliveryWorker
+from drive import download_file_from_drive
+from filecache import AttachmentCache
+from metrics import instrument_requests
+from recurrence import catch_up
+from scheduler import ReminderScheduler
+from sender import MAX_MESSAGE_LENGTH, Dispatcher
+
+# The bot and the reminder side of the application: firing reminders and delivering them. The
+# scheduler role imports only this module; main.py adds the bot handlers on top of it.
+
+load_dotenv()
+bot = telebot.TeleBot(os.getenv("TELEGRAM_API_TOKEN"))
+dispatcher = Dispatcher(bot)
+# Telegram albums hold 2 to 10 files.
+MEDIA_GROUP_SIZE = 10
+
+
+def send_reminder(delivery, reminder):
+    # The text is part 1 and each attachment one more part; parts already sent by an earlier
+    # attempt of this delivery are skipped.
+    user_id = delivery.user_id
+    message = f"Reminder: {reminder[1]}"
+    files = get_all_files_info_from_database(reminder[0]) if reminder[3] else []
+    if files:
+
+        message += "\nAttachments:"
+        for file_id, save_path, telegram_file_id in files:
+            message += f"\n{save_path}"
+
+    if delivery.parts_sent < 1:
+        dispatcher.send_message(user_id, message).result()
+        delivery.sent(1)
+    for part, file in enumerate(files, 2):
+        if part <= delivery.parts_sent:
+            continue
+        send_file(user_id, file)
+        delivery.sent(part)
+
+
+def open_cached(file_id):
+    # Drive downloads go through the local cache, so later firings are served from disk.
+    return attachment_cache.open(file_id, lambda out: download_file_from_drive(file_id, out))
+
+
+def send_file(user_id, file):
+    file_id, save_path, telegram_file_id = file
+    # Files Telegram already has are resent by file_id; Drive is only the fallback.
+    if telegram_file_id:
+        try:
+            dispatcher.submit(user_id, bot.send_document, user_id, telegram_file_id).result()
+            return
+        except telebot.apihelper.ApiTelegramException as e:
+            print("Error when resending a file by its Telegram id:", e)
+    with open_cached(file_id) as contents:
+        sent = dispatcher.submit(user_id, bot.send_document, user_id, contents, visible_file_name=save_path).result()
+    update_telegram_file_id(file_id, sent.document.file_id)
+
+
+def send_album(user_id, files, by_telegram_id=True):
+    # Sends 2 to MEDIA_GROUP_SIZE files in one request. If Telegram refuses one of the file_ids,
+    # the whole album is sent again from Drive.
+    with contextlib.ExitStack() as stack:
+        media = []
+        for file_id, save_path, telegram_file_id in files:
+            if by_telegram_id and telegram_file_id:
+                media.append(types.InputMediaDocument(telegram_file_id))
+            else:
+                media.append(types.InputMediaDocument((save_path, stack.enter_context(open_cached(file_id)))))
+        try:
+            sent = dispatcher.submit(user_id, bot.send_media_group, user_id, media).result()
+        except telebot.apihelper.ApiTelegramException as e:
+            if not by_telegram_id or not any(file[2] for file in files):
+                raise
+            print("Error when resending files by their Telegram ids:", e)
+            return send_album(user_id, files, by_telegram_id=False)
+    for (file_id, _, telegram_file_id), message in zip(files, sent):
+        if not (by_telegram_id and telegram_file_id):
+            update_telegram_file_id(file_id, message.document.file_id)
+
+
+def digest_texts(reminders):
+    # The digest as few messages as fit, each under Telegram's length limit.
+    entries = []
+    for number, (reminder, files) in enumerate(reminders, 1):
+        entry = f"{number}. {reminder[1]}"
+        if files:
+            entry += "\n    Attachments: " + ", ".join(file[1] for file in files)
+        entries.append(entry[:MAX_MESSAGE_LENGTH - 1])
+    texts = [f"Reminders ({len(reminders)}):"]
+    for entry in entries:
+        if len(texts[-1]) + 1 + len(entry) > MAX_MESSAGE_LENGTH:
+            texts.append(entry)
+        else:
+            texts[-1] += "\n" + entry
+    return texts
+
+
+def send_digest(delivery, reminders):
+    # The text messages come first, then one album per MEDIA_GROUP_SIZE attachments; each counts
+    # as one part, so a retry resumes after the last part sent.
+    user_id = delivery.user_id
+    reminders = [(reminder, get_all_files_info_from_database(reminder[0]) if reminder[3] else [])
+                 for reminder in reminders]
+    parts = [lambda text=text: dispatcher.send_message(user_id, text).result() for text in digest_texts(reminders)]
+    files = [file for _, reminder_files in reminders for file in reminder_files]
+    for start in range(0, len(files), MEDIA_GROUP_SIZE):
+        album = files[start:start + MEDIA_GROUP_SIZE]
+        if len(album) == 1:
+            parts.append(lambda file=album[0]: send_file(user_id, file))
+        else:
+            parts.append(lambda album=album: send_album(user_id, album))
+    for part, send in enumerate(parts, 1):
+        if part <= delivery.parts_sent:
+            continue
+        send()
+        delivery.sent(part)
+
+
+def deliver_reminder(delivery):
+    # Runs on a delivery worker for each outbox entry.
+    if delivery.digest:
+        reminders = [get_reminder_info(delivery.user_id, reminder_id) for reminder_id in delivery.reminder_ids]
+        # Reminders deleted after they fired are left out.
+        reminders = [reminder for reminder in reminders if reminder is not None]
+        if reminders:
+            send_digest(delivery, reminders)
+        return
+    reminder = get_reminder_info(delivery.user_id, delivery.reminder_id)
+    if reminder is None:
+        return  # deleted after it fired
+    send_reminder(delivery, reminder)
+
+
+def check_reminders(user_id, reminder_id):
+    # Fired by the scheduler for a reminder it has claimed. Its due occurrences are queued in the
+    # outbox as the claim is released; the delivery worker sends them.
+    reminder = get_reminder_info(user_id, reminder_id)
+    if reminder is None or reminder[4]:
+        return
+    if not reminder[6]:
+        reminder_scheduler.complete(user_id, reminder[0], occurrences=[reminder[2]])
+    else:
+        # Recurring reminders keep a single row; firing moves due_at to the next occurrence.
+        occurrences, next_due = catch_up(reminder[2], reminder[6], int(time.time()))
+        reminder_scheduler.complete(user_id, reminder[0], next_due, occurrences)
+    delivery_worker.wake()
+
+
+reminder_scheduler = ReminderScheduler(check_reminders)
+delivery_worker = DeliveryWorker(deliver_reminder)
+drive_collector = DriveCollector()
+attachment_cache = AttachmentCache()
+instrument_requests()
@@ -0,0 +1,27 @@
+import json
+import os
+import sys
+
+import requests
+from dotenv import load_dotenv
+
+# Replays recorded Telegram updates (one JSON object per line) against a local webhook:
+#   BOT_MODE=webhook python main.py
+#   python replay_updates.py updates.jsonl [http://localhost:5000/webhook]
+
+load_dotenv()
+
+
+def replay(path, url):
+    headers = {}
+    if os.getenv("WEBHOOK_SECRET"):
+        headers["X-Telegram-Bot-Api-Secret-Token"] = os.getenv("WEBHOOK_SECRET")
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                response = requests.post(url, json=json.loads(line), headers=headers, timeout=10)
+                print(response.status_code, line.strip()[:80])
+
+
+if __name__ == '__main__':
+    replay(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else "http://localhost:5000/webhook")
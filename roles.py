@@ -0,0 +1,83 @@
+import os
+import sys
+import threading
+
+from dotenv import load_dotenv
+
+# Before the project imports: db, drive and the rest read their settings from the environment
+# when imported, and so does this module below.
+load_dotenv()
+
+import migrate
+
+# Starts the bot:
+#   python roles.py [api] [poller] [scheduler]
+# Roles can also be given in BOT_ROLES, comma-separated; by default one process runs all of
+# them. Each role imports only what it needs:
+#   api       - the FastAPI server (server.py): /metrics, and /webhook with the bot handlers in
+#               webhook mode
+#   poller    - long-polls Telegram and runs the bot handlers (main.py); idle in webhook mode
+#   scheduler - the reminder scheduler, delivery worker and Drive collector (reminders.py)
+# Processes share the SQLite database. A scheduler running apart from the handlers sees new
+# and edited reminders at its next poll, up to scheduler.POLL_INTERVAL seconds later.
+
+ROLES = ('api', 'poller', 'scheduler')
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+API_PORT = int(os.getenv("API_PORT", 5000))
+# Processes without the api role serve their metrics on this port, if set.
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+
+def parse_roles(args):
+    roles = args or [role for role in os.getenv("BOT_ROLES", ",".join(ROLES)).split(",") if role]
+    unknown = sorted(set(roles) - set(ROLES))
+    if unknown:
+        sys.exit(f"Unknown roles: {', '.join(unknown)}. Choose from: {', '.join(ROLES)}.")
+    return roles
+
+
+def handles_updates(roles):
+    return 'api' in roles if BOT_MODE == 'webhook' else 'poller' in roles
+
+
+def load(roles):
+    # Imports the modules the roles run; separate from run() so bench.py can time it.
+    if 'scheduler' in roles:
+        import reminders
+    if handles_updates(roles):
+        import main
+    if 'api' in roles:
+        import server
+
+
+def run(roles):
+    if BOT_MODE == 'webhook' and 'api' in roles and not os.getenv("WEBHOOK_SECRET"):
+        sys.exit("Set WEBHOOK_SECRET to run in webhook mode: it authenticates the updates Telegram posts.")
+    migrate.migrate()
+    load(roles)
+    if 'scheduler' in roles:
+        from reminders import delivery_worker, drive_collector, reminder_scheduler
+        reminder_scheduler.start()
+        delivery_worker.start()
+        drive_collector.start()
+    if BOT_MODE == 'webhook':
+        if 'api' in roles:
+            from main import bot
+            bot.set_webhook(url=os.getenv("WEBHOOK_URL"), secret_token=os.getenv("WEBHOOK_SECRET"))
+    elif 'poller' in roles:
+        from main import bot, start_bot_polling
+        bot.remove_webhook()
+        threading.Thread(target=start_bot_polling, daemon=True).start()
+    if 'api' in roles:
+        import uvicorn
+        # No reloader: it would serve /metrics from a child process that sees none of this one's work.
+        uvicorn.run('server:app', host='0.0.0.0', port=API_PORT)
+        return
+    if METRICS_PORT:
+        from prometheus_client import start_http_server
+        start_http_server(int(METRICS_PORT))
+    threading.Event().wait()
+
+
+if __name__ == '__main__':
+    run(parse_roles(sys.argv[1:]))
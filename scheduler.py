@@ -0,0 +1,145 @@
+import heapq
+import os
+import socket
+import threading
+import time
+import uuid
+
+import db
+from metrics import REMINDERS_DUE, REMINDERS_FAILED, SCHEDULER_LAG, SCHEDULER_STARTUP
+
+LEASE_SECONDS = 300
+CLAIM_BATCH = 100
+POLL_INTERVAL = 30
+# A backlog of overdue reminders, e.g. after downtime, is claimed CLAIM_BATCH at a time with
+# this many seconds between batches, so a restart does not flood the outbox and Telegram.
+CATCH_UP_INTERVAL = 2
+# Loading the schedule should take less than this; slower starts are logged.
+STARTUP_BUDGET = float(os.getenv("SCHEDULER_STARTUP_BUDGET", 2))
+
+
+class ReminderScheduler:
+    # Min-heap of (due timestamp, reminder id, user id). Entries are never removed from the
+    # middle of the heap: self._due holds the live due time of each reminder and heap
+    # entries that disagree with it are discarded when they reach the top.
+    #
+    # The heap only decides when to wake up. Due reminders are then claimed in the database
+    # with a lease, so several schedulers can share one database without delivering a reminder
+    # twice, and the reminders of a worker that died are claimed again once its leases expire.
+    # Every POLL_INTERVAL seconds the heap picks up reminders created by other processes.
+    #
+    # The heap only holds reminders due before the next poll, read from the (done, due_at)
+    # index, so startup does not depend on how many reminders exist. Overdue reminders are
+    # never put in the heap: they are claimed straight from the database in paced batches.
+
+    def __init__(self, fire, worker_id=None):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._fire = fire
+        self._heap = []
+        self._due = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._next_poll = 0
+        self._catch_up_at = None
+        self.startup_seconds = None
+
+    def _pull(self, since, until):
+        rows = db.scheduled_reminders(int(since), int(until))
+        with self._cond:
+            for reminder_id, user_id, due in rows:
+                if self._due.get(reminder_id) != due:
+                    self._due[reminder_id] = due
+                    self._heap.append((due, reminder_id, user_id))
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def load(self):
+        start = time.perf_counter()
+        now = time.time()
+        self._pull(now, now + POLL_INTERVAL)
+        self._next_poll = now + POLL_INTERVAL
+        self._catch_up_at = now  # claim whatever became due while the bot was down
+        self.startup_seconds = time.perf_counter() - start
+        SCHEDULER_STARTUP.set(self.startup_seconds)
+        if self.startup_seconds > STARTUP_BUDGET:
+            print(f"Loading the reminder schedule took {self.startup_seconds:.2f}s, "
+                  f"over the {STARTUP_BUDGET:g}s budget.")
+
+    def schedule(self, reminder_id, user_id, due):
+        with self._cond:
+            self._due[reminder_id] = due
+            heapq.heappush(self._heap, (due, reminder_id, user_id))
+            if self._heap[0][1] == reminder_id:
+                self._cond.notify()
+
+    def cancel(self, reminder_id):
+        with self._cond:
+            self._due.pop(reminder_id, None)
+
+    def refresh(self, user_id, reminder_id):
+        # Re-read a reminder after it was created, edited, completed or deleted. When the
+        # scheduler runs in another process, that process picks the change up at its next poll.
+        if self._thread is None:
+            return
+        reminder = db.get_reminder_info(user_id, reminder_id)
+        if reminder is None or reminder[4]:
+            self.cancel(reminder_id)
+        else:
+            self.schedule(reminder_id, user_id, reminder[2])
+
+    def complete(self, user_id, reminder_id, next_due=None, occurrences=()):
+        # Called by the fire callback to release a claimed reminder and queue its deliveries.
+        completed = db.complete_claimed_reminder(reminder_id, self.worker_id, next_due, user_id, occurrences)
+        if completed and next_due is not None:
+            self.schedule(reminder_id, user_id, next_due)
+
+    def _next_due(self):
+        while self._heap:
+            due, reminder_id, user_id = self._heap[0]
+            if self._due.get(reminder_id) == due:
+                return self._heap[0]
+            heapq.heappop(self._heap)
+        return None
+
+    def _fire_due(self, now):
+        # Claims and fires one batch; returns True if more reminders may be due.
+        claimed = db.claim_due_reminders(self.worker_id, now, LEASE_SECONDS, CLAIM_BATCH)
+        REMINDERS_DUE.inc(len(claimed))
+        for reminder_id, user_id, due in claimed:
+            SCHEDULER_LAG.observe(max(time.time() - due, 0))
+            try:
+                self._fire(user_id, reminder_id)
+            except Exception as e:
+                REMINDERS_FAILED.labels("enqueue").inc()
+                print("Error when queueing a reminder:", e)
+        return len(claimed) == CLAIM_BATCH
+
+    def run(self):
+        while True:
+            with self._cond:
+                now = time.time()
+                entry = self._next_due()
+                wake = min(entry[0], self._next_poll) if entry else self._next_poll
+                if self._catch_up_at is not None:
+                    wake = min(wake, self._catch_up_at)
+                if wake > now:
+                    self._cond.wait(wake - now)
+                    continue
+                while entry is not None and entry[0] <= now:
+                    heapq.heappop(self._heap)
+                    del self._due[entry[1]]
+                    entry = self._next_due()
+                self._catch_up_at = None
+            try:
+                if now >= self._next_poll:
+                    self._next_poll = now + POLL_INTERVAL
+                    self._pull(now, now + POLL_INTERVAL)
+                if self._fire_due(int(now)):
+                    self._catch_up_at = time.time() + CATCH_UP_INTERVAL
+            except Exception as e:
+                print("Error when claiming reminders:", e)
+
+    def start(self):
+        self.load()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
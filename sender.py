@@ -0,0 +1,193 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from telebot.apihelper import ApiTelegramException
+
+# Telegram allows about 30 messages per second overall and about one per second per chat,
+# with short bursts tolerated.
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 5
+SENDER_WORKERS = 4
+MAX_MESSAGE_LENGTH = 4096
+
+
+def rewind(value):
+    # Seeks every file a request argument uploads back to its start, so a retry sends the whole
+    # file again: files passed directly, as (name, file) pairs or inside InputMedia lists.
+    if hasattr(value, "seek"):
+        value.seek(0)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            rewind(item)
+    elif hasattr(value, "media"):
+        rewind(value.media)
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _fill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        self._fill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class SendJob:
+
+    def __init__(self, func, args, kwargs, text=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        # Plain text messages without markup can be merged with their neighbours.
+        self.text = text
+        self.futures = [Future()]
+
+
+class ChatQueue:
+
+    def __init__(self):
+        self.jobs = deque()
+        self.bucket = TokenBucket(CHAT_RATE, CHAT_BURST)
+        self.blocked_until = 0
+        self.busy = False
+
+
+class Dispatcher:
+    # Central outbound queue. Chats are served round-robin by a few worker threads, at most one
+    # request per chat in flight so each chat's messages keep their order.
+
+    def __init__(self, bot, workers=SENDER_WORKERS):
+        self._bot = bot
+        self._workers = workers
+        self._chats = OrderedDict()
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, chat_id, func, *args, text=None, **kwargs):
+        job = SendJob(func, args, kwargs, text)
+        with self._cond:
+            if not self._threads:
+                self._start()
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = ChatQueue()
+            chat.jobs.append(job)
+            self._cond.notify()
+        return job.futures[0]
+
+    def send_message(self, chat_id, text, **kwargs):
+        # Returns a Future; call .result() when the sent Message is needed.
+        return self.submit(chat_id, self._bot.send_message, chat_id, text,
+                           text=None if kwargs else text, **kwargs)
+
+    def _start(self):
+        for _ in range(self._workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _coalesce(self, chat):
+        job = chat.jobs.popleft()
+        if job.text is None:
+            return job
+        texts = [job.text]
+        length = len(job.text)
+        while chat.jobs and chat.jobs[0].text is not None and length + 2 + len(chat.jobs[0].text) <= MAX_MESSAGE_LENGTH:
+            other = chat.jobs.popleft()
+            texts.append(other.text)
+            length += 2 + len(other.text)
+            job.futures.extend(other.futures)
+        if len(texts) > 1:
+            job.text = "\n\n".join(texts)
+            job.args = job.args[:1] + (job.text,)
+        return job
+
+    def _next_job(self):
+        # Returns (chat_id, job) or the number of seconds to wait before something can be sent.
+        now = time.monotonic()
+        wait = self._global.wait_time(now)
+        if wait > 0:
+            return wait
+        wait = None
+        idle = []
+        for chat_id, chat in self._chats.items():
+            if chat.busy or not chat.jobs:
+                if not chat.busy and chat.bucket.wait_time(now) == 0 and chat.bucket.tokens >= chat.bucket.capacity:
+                    idle.append(chat_id)
+                continue
+            chat_wait = max(chat.bucket.wait_time(now), chat.blocked_until - now)
+            if chat_wait > 0:
+                wait = chat_wait if wait is None else min(wait, chat_wait)
+                continue
+            chat.busy = True
+            chat.bucket.take()
+            self._global.take()
+            self._chats.move_to_end(chat_id)
+            return chat_id, self._coalesce(chat)
+        # Chats with nothing queued and a full bucket carry no state worth keeping.
+        for chat_id in idle:
+            del self._chats[chat_id]
+        return wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    entry = self._next_job()
+                    if isinstance(entry, tuple):
+                        break
+                    self._cond.wait(entry)
+            self._send(*entry)
+
+    def _send(self, chat_id, job):
+        retry_after = None
+        try:
+            rewind(job.args)
+            rewind(list(job.kwargs.values()))
+            result = job.func(*job.args, **job.kwargs)
+        except ApiTelegramException as e:
+            if e.error_code != 429:
+                self._finish(chat_id, job, exception=e)
+                return
+            retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+        except Exception as e:
+            self._finish(chat_id, job, exception=e)
+            return
+        if retry_after is None:
+            self._finish(chat_id, job, result=result)
+            return
+        with self._cond:
+            chat = self._chats[chat_id]
+            chat.blocked_until = time.monotonic() + retry_after
+            chat.jobs.appendleft(job)
+            chat.busy = False
+            self._cond.notify_all()
+
+    def _finish(self, chat_id, job, result=None, exception=None):
+        with self._cond:
+            chat = self._chats[chat_id]
+            chat.busy = False
+            self._cond.notify_all()
+        if exception is not None:
+            print("Error when sending a Telegram message:", exception)
+        for future in job.futures:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
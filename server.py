@@ -1,11 +1,45 @@
-import schedule
-from fastapi import FastAPI
-import datetime
-from main import bot
+import hmac
+import os
+
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 
 app = FastAPI()
+update_queue = None
+
+
+@app.on_event('startup')
+def start_webhook_mode():
+    # In webhook mode updates arrive here, so this process loads the bot handlers; in polling
+    # mode the server only exposes /metrics and needs none of them.
+    global update_queue
+    if BOT_MODE == 'webhook':
+        from main import bot
+        from updates import UpdateQueue
+        # The queue's workers run the handlers themselves; telebot's own pool would drop the
+        # per-chat ordering and hide the queue's back-pressure.
+        bot.threaded = False
+        update_queue = UpdateQueue(bot.process_new_updates)
+        update_queue.start()
+
+
+@app.post('/webhook')
+async def webhook(request: Request, x_telegram_bot_api_secret_token: str = Header(None)):
+    if update_queue is None:
+        raise HTTPException(status_code=404)
+    # Without a secret anyone could post updates, so every request is refused; roles.py does
+    # not start webhook mode without one.
+    if not WEBHOOK_SECRET or not hmac.compare_digest((x_telegram_bot_api_secret_token or "").encode(),
+                                                     WEBHOOK_SECRET.encode()):
+        raise HTTPException(status_code=403)
+    if not update_queue.put(await request.json()):
+        raise HTTPException(status_code=503)
+    return {}
 
 
-@app.post('/message')
-async def message():
-    schedule.run_pending()
+@app.get('/metrics')
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
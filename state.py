@@ -0,0 +1,82 @@
+import json
+import os
+import threading
+import time
+
+import db
+
+STATE_TTL = 24 * 60 * 60
+SWEEP_INTERVAL = 60
+
+
+class StateStore:
+    # Conversation state of each (chat, user) pair, e.g. the description of a reminder being
+    # created, the reply a flow is waiting for or the reminder that incoming files are attached
+    # to. Entries expire STATE_TTL seconds after their last update. With `persistent` the SQLite
+    # conversation_state table is the source of truth, so several processes can share state and
+    # it survives restarts.
+
+    def __init__(self, ttl=STATE_TTL, persistent=False):
+        self._ttl = ttl
+        self._persistent = persistent
+        self._lock = threading.Lock()
+        self._states = {}
+        self._last_sweep = 0
+
+    def _load(self, key):
+        if self._persistent:
+            row = db.connection().execute("SELECT data, updated_at FROM conversation_state "
+                                          "WHERE chat_id = ? AND user_id = ?", key).fetchone()
+            entry = (json.loads(row[0]), row[1]) if row else None
+        else:
+            entry = self._states.get(key)
+        if entry is None or entry[1] < time.time() - self._ttl:
+            return {}
+        return entry[0]
+
+    def _store(self, key, data):
+        now = int(time.time())
+        if self._persistent:
+            with db.transaction() as c:
+                if data:
+                    c.execute("INSERT OR REPLACE INTO conversation_state (chat_id, user_id, data, updated_at) "
+                              "VALUES (?, ?, ?, ?)", key + (json.dumps(data), now))
+                else:
+                    c.execute("DELETE FROM conversation_state WHERE chat_id = ? AND user_id = ?", key)
+        elif data:
+            self._states[key] = (data, now)
+        else:
+            self._states.pop(key, None)
+        if now - self._last_sweep > SWEEP_INTERVAL:
+            self._last_sweep = now
+            self._sweep(now)
+
+    def _sweep(self, now):
+        if self._persistent:
+            with db.transaction() as c:
+                c.execute("DELETE FROM conversation_state WHERE updated_at < ?", (now - self._ttl,))
+        else:
+            for key in [key for key, (_, updated) in self._states.items() if updated < now - self._ttl]:
+                del self._states[key]
+
+    def get(self, chat_id, user_id, name, default=None):
+        with self._lock:
+            return self._load((chat_id, user_id)).get(name, default)
+
+    def set(self, chat_id, user_id, **values):
+        with self._lock:
+            key = (chat_id, user_id)
+            data = dict(self._load(key))
+            data.update(values)
+            self._store(key, {name: value for name, value in data.items() if value is not None})
+
+    def clear(self, chat_id, user_id, *names):
+        # Without names the whole state of the pair is dropped.
+        with self._lock:
+            key = (chat_id, user_id)
+            data = {name: value for name, value in self._load(key).items() if names and name not in names}
+            self._store(key, data)
+
+
+def create_state_store():
+    return StateStore(persistent=os.getenv("STATE_BACKEND", "memory") == "sqlite")
@@ -0,0 +1,56 @@
+import queue
+import threading
+
+from telebot import types
+
+UPDATE_WORKERS = 4
+UPDATE_QUEUE_SIZE = 1000
+UPDATE_BATCH_SIZE = 50
+
+
+def update_key(data):
+    # Updates of one chat must be handled in order (next-step handlers depend on it), so they
+    # are always routed to the same worker.
+    for kind in ('message', 'edited_message', 'callback_query', 'channel_post', 'my_chat_member'):
+        payload = data.get(kind)
+        if payload:
+            sender = payload.get('chat') or payload.get('from') or {}
+            return sender.get('id', 0)
+    return data.get('update_id', 0)
+
+
+class UpdateQueue:
+    # Bounded queues of raw webhook updates drained in batches by worker threads.
+
+    def __init__(self, process, workers=UPDATE_WORKERS, size=UPDATE_QUEUE_SIZE, batch_size=UPDATE_BATCH_SIZE):
+        self._process = process
+        self._queues = [queue.Queue(maxsize=max(size // workers, 1)) for _ in range(workers)]
+        self._batch_size = batch_size
+        self._threads = []
+
+    def put(self, data):
+        # Returns False when the queue is full, so the webhook can ask Telegram to redeliver.
+        try:
+            self._queues[update_key(data) % len(self._queues)].put_nowait(data)
+            return True
+        except queue.Full:
+            return False
+
+    def _work(self, updates):
+        while True:
+            batch = [updates.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(updates.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._process([types.Update.de_json(data) for data in batch])
+            except Exception as e:
+                print("Error when processing Telegram updates:", e)
+
+    def start(self):
+        for updates in self._queues:
+            thread = threading.Thread(target=self._work, args=(updates,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
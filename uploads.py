@@ -0,0 +1,82 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+UPLOAD_WORKERS = 4
+MAX_PENDING_UPLOADS = 64
+
+
+class UploadBatch:
+    # Consecutive uploads from one user that share a media group (album). Files of a batch are
+    # uploaded in parallel; batches of the same user run one after another.
+
+    def __init__(self, group_id):
+        self.group_id = group_id
+        self.queued = []
+        self.running = 0
+        self.uploaded = []
+        self.failed = []
+
+
+class UploadQueue:
+
+    def __init__(self, notify, workers=UPLOAD_WORKERS, max_pending=MAX_PENDING_UPLOADS):
+        self._notify = notify
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upload')
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self._pending = 0
+        self._max_pending = max_pending
+
+    def submit(self, user_id, group_id, name, job):
+        # Returns False when the queue is full; the caller should ask the user to retry.
+        with self._lock:
+            if self._pending >= self._max_pending:
+                return False
+            self._pending += 1
+            lane = self._lanes.setdefault(user_id, deque())
+            if lane and group_id is not None and lane[-1].group_id == group_id:
+                batch = lane[-1]
+                new_batch = False
+            else:
+                batch = UploadBatch(group_id)
+                lane.append(batch)
+                new_batch = True
+            batch.queued.append((name, job))
+            if lane[0] is batch:
+                self._start(user_id, batch)
+        if new_batch:
+            self._notify(user_id, "Uploading the files, I will let you know when they are saved.")
+        return True
+
+    def _start(self, user_id, batch):
+        while batch.queued:
+            name, job = batch.queued.pop(0)
+            batch.running += 1
+            self._executor.submit(self._run, user_id, batch, name, job)
+
+    def _run(self, user_id, batch, name, job):
+        try:
+            job()
+            ok = True
+        except Exception as e:
+            print("Error when uploading a file to Google Drive:", e)
+            ok = False
+        with self._lock:
+            self._pending -= 1
+            (batch.uploaded if ok else batch.failed).append(name)
+            batch.running -= 1
+            if batch.running or batch.queued:
+                return
+            lane = self._lanes[user_id]
+            lane.popleft()
+            if lane:
+                self._start(user_id, lane[0])
+            else:
+                del self._lanes[user_id]
+        message = ""
+        if batch.uploaded:
+            message += "Files saved: " + ", ".join(batch.uploaded)
+        if batch.failed:
+            message += "\nCould not save: " + ", ".join(batch.failed)
+        self._notify(user_id, message.strip())
@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import VIEW_CACHE_REQUESTS, child
+
+VIEW_CACHE_SIZE = int(os.getenv("VIEW_CACHE_SIZE", 10000))
+# Reminders changed by another process (e.g. a scheduler started with its own role) are not
+# invalidated here; entries are dropped after this many seconds so those changes show up.
+VIEW_CACHE_TTL = float(os.getenv("VIEW_CACHE_TTL", 30))
+
+
+class ViewCache:
+    # In-process LRU cache of the reminder list pages, keyed by user and page. Writes in this
+    # process invalidate all of a user's pages once they commit. Reads that overlapped an
+    # invalidation do not store their result, since they may have read the rows before the commit.
+
+    def __init__(self, max_entries=VIEW_CACHE_SIZE, ttl=VIEW_CACHE_TTL):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id, key, load):
+        key = (user_id, key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                child(VIEW_CACHE_REQUESTS, "hit").inc()
+                return entry[1]
+            self.misses += 1
+            child(VIEW_CACHE_REQUESTS, "miss").inc()
+            generation = self._generation
+        value = load()
+        with self._lock:
+            if self._generation == generation:
+                self._entries[key] = (time.monotonic() + self._ttl, value)
+                self._entries.move_to_end(key)
+                self._keys.setdefault(user_id, set()).add(key)
+                while len(self._entries) > self._max_entries:
+                    old, _ = self._entries.popitem(last=False)
+                    self._forget(old)
+                    self.evictions += 1
+        return value
+
+    def _forget(self, key):
+        keys = self._keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[key[0]]
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._generation += 1
+            for key in self._keys.pop(user_id, ()):
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else None,
+                    "evictions": self.evictions, "entries": len(self._entries)}